@@ -0,0 +1,178 @@
+from bench_common import ROOT_DIR
+
+import rendering as ren
+import numpy as np
+
+
+"""
+Benchmark cases. Every case declares its kernels when it is created (so a process running a single case compiles
+only what the case uses) and returns the function rendering one frame, and optionally a function reporting the
+device memory used.
+"""
+
+
+__CASES__ = { }
+
+
+def case(name: str, frames: int = 30, **params):
+    def decorator(f):
+        __CASES__[name] = (f, frames, params)
+        return f
+    return decorator
+
+
+def get_cases():
+    return __CASES__
+
+
+__DRAGON__ = f"{ROOT_DIR}/models/dragon.obj"
+__MARBLE__ = f"{ROOT_DIR}/models/marble2.jpg"
+
+
+@ren.kernel_struct
+class Transforms:
+    World: ren.float4x4
+    View: ren.float4x4
+    Proj: ren.float4x4
+
+
+def _update_transforms(transforms, frame, width, height):
+    with ren.mapped(transforms) as map:
+        map["World"] = ren.rotate(frame * 0.05, ren.make_float3(0, 1, 0))
+        map["View"] = ren.look_at(ren.make_float3(0, 0.3, 1.0), ren.make_float3(0, 0, 0), ren.make_float3(0, 1, 0))
+        map["Proj"] = ren.perspective(aspect_ratio=width / height)
+
+
+def _raster_memory(raster):
+    return lambda: {'scratch_bytes': raster.get_scratch().get_allocated_bytes()}
+
+
+@case('load_obj_dragon', frames=3)
+def load_obj_dragon():
+    return lambda frame: ren.load_obj(__DRAGON__), None
+
+
+for resolution in (32, 128, 512):
+    @case(f'manifold_{resolution}', resolution=resolution)
+    def manifold(resolution):
+        return lambda frame: ren.manifold(resolution, resolution), None
+
+
+def _dragon_raster(width, height, textured: bool):
+    mesh, _ = ren.load_obj(__DRAGON__)[0]
+    render_target = ren.create_offline_presenter(width, height).get_render_target()
+    transforms = ren.create_struct(Transforms)
+
+    @ren.kernel_struct
+    class Vertex_Out:
+        proj: ren.float4
+        L: ren.float3
+        C: ren.float2
+
+    @ren.kernel_function
+    def bench_transform(vertex: ren.MeshVertex, info: Transforms) -> Vertex_Out:
+        """
+        float d = 0.2f + max(0.0f, dot(vertex.N, normalize((float3)(1,1,1))));
+        float4 H = (float4)(vertex.P.x, vertex.P.y, vertex.P.z, 1.0);
+        H = mul(H, info.World);
+        H = mul(H, info.View);
+        H = mul(H, info.Proj);
+        Vertex_Out o;
+        o.proj = H;
+        o.L = (float3)(d, d, d);
+        o.C = vertex.P.xy * 2;
+        return o;
+        """
+
+    if textured:
+        @ren.kernel_struct
+        class Materials:
+            DiffuseMap: ren.Texture2D
+
+        @ren.kernel_function
+        def bench_textured(fragment: Vertex_Out, info: Materials) -> ren.float4:
+            """
+            float3 diff = sample2D(info.DiffuseMap, fragment.C).xyz;
+            return (float4)(diff * fragment.L, 1);
+            """
+
+        _, texture_descriptor = ren.load_texture(__MARBLE__, mipmaps=True)
+        materials = ren.create_struct(Materials)
+        with ren.mapped(materials) as map:
+            map["DiffuseMap"] = texture_descriptor.get()
+        raster = ren.Raster(render_target, bench_transform, transforms, bench_textured, materials)
+    else:
+        @ren.kernel_function
+        def bench_lit(fragment: Vertex_Out, info: Transforms) -> ren.float4:
+            """
+            return (float4)(fragment.L, 1);
+            """
+
+        raster = ren.Raster(render_target, bench_transform, transforms, bench_lit, transforms)
+    return mesh, transforms, raster
+
+
+for width, height in ((640, 480), (1920, 1080)):
+    for primitive in ('points', 'triangles', 'textured'):
+        @case(f'{primitive}_{width}x{height}', primitive=primitive, width=width, height=height)
+        def draw_dragon(primitive, width, height):
+            mesh, transforms, raster = _dragon_raster(width, height, primitive == 'textured')
+
+            def frame(index):
+                _update_transforms(transforms, index, width, height)
+                ren.clear(raster.get_render_target())
+                ren.clear(raster.get_depth_buffer(), 1.0)
+                if primitive == 'points':
+                    raster.draw_points(mesh.vertices)
+                else:
+                    raster.draw_triangles(mesh.vertices, None)
+
+            def memory():
+                stats = _raster_memory(raster)()
+                if primitive == 'textured':
+                    stats['pool_bytes'] = ren.get_memory_pool().get_statistics()['peak_allocated_bytes']
+                return stats
+            return frame, memory
+
+
+@case('mandelbrot_1920x1080', width=1920, height=1080)
+@case('mandelbrot_512', width=512, height=512)
+def mandelbrot(width, height):
+    # kernels of tutorials/lesson04_mandelbrot_animation.py
+    @ren.kernel_struct
+    class MandelbrotInfo:
+        N: int
+        C: ren.float2
+
+    @ren.kernel_function
+    def get_color(m: np.float32) -> ren.float4:
+        """
+        m = min(m, 10.0f);
+        float s = 2*(1.0f / (1 + exp(-m)) - 0.5f);
+        return (float4)(0.0f, 1.0f-s, fmod(s+0.5,1.0), 1.0f);
+        """
+
+    @ren.kernel_main
+    def compute_mandelbrot(im: ren.w_image2d_t, info: MandelbrotInfo):
+        """
+        int2 dim = get_image_dim(im);
+        int px = thread_id % dim.x;
+        int py = thread_id / dim.x;
+        float2 Z = ((float2)((px + 0.5f)/dim.x, (py + 0.5f)/dim.y)) * 2.0f - 1.0f;
+        for (int i=0; i<info.N; i++)
+            Z = (float2)(Z.x*Z.x - Z.y*Z.y, 2*Z.x*Z.y) + info.C;
+        float m = sqrt(dot(Z, Z));
+        write_imagef(im, (int2)(px,py), get_color(m));
+        """
+
+    presenter = ren.create_offline_presenter(width, height)
+    mandelbrot_info = ren.create_struct(MandelbrotInfo)
+
+    def frame(index):
+        t = index / 60.0
+        with ren.mapped(mandelbrot_info) as map:
+            map["N"] = 100
+            map["C"] = ren.make_float2(0.09 + np.cos(t * 0.7) * 0.01, 0.61 + np.sin(t) * 0.01)
+        compute_mandelbrot[presenter.get_render_target().shape](presenter.get_render_target(), mandelbrot_info)
+        presenter.present()
+    return frame, None
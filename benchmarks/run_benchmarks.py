@@ -0,0 +1,144 @@
+"""
+Runs the benchmark cases offscreen (no window is created). Every case runs in its own process, so the cold start
+includes importing the package, creating the device context and compiling the programs. Results are stored as JSON
+to compare runs over time.
+
+    python benchmarks/run_benchmarks.py                     # all cases, results in benchmarks/results
+    python benchmarks/run_benchmarks.py -k triangles -f 60  # cases containing 'triangles', 60 timed frames
+    python benchmarks/run_benchmarks.py --no-program-cache  # include the full compilation in cold start
+"""
+import time
+__START__ = time.perf_counter()  # cold start is measured from the process start
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+try:
+    import resource
+except ImportError:
+    resource = None  # peak host memory is not reported (e.g. Windows)
+
+__CURRENT_PATH__ = os.path.dirname(os.path.abspath(__file__))
+__WARMUP_FRAMES__ = 2
+
+
+def _get_peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # kilobytes in linux
+
+
+def run_case(name: str, frames: int = None) -> dict:
+    """
+    Runs a case in the current process and returns its measures (times in seconds, memory in bytes).
+    """
+    import bench_common
+    import rendering as ren
+    from rendering._core import get_queue, get_context
+
+    tracer = ren.start_tracing()  # only host spans, program builds are summed as compile time
+    import cases
+    factory, default_frames, params = cases.get_cases()[name]
+    frames = default_frames if frames is None else frames
+    frame, memory = factory(**params)
+    setup_time = time.perf_counter() - __START__
+    frame(0)
+    get_queue().finish()
+    cold_start = time.perf_counter() - __START__
+    ren.stop_tracing()
+    compile_time = sum((end - start) * 1e-9 for span, _, start, end in tracer.host_spans if span == 'build_program')
+
+    for index in range(1, 1 + __WARMUP_FRAMES__):
+        frame(index)
+    get_queue().finish()
+    times = []
+    for index in range(1 + __WARMUP_FRAMES__, 1 + __WARMUP_FRAMES__ + frames):
+        start = time.perf_counter()
+        frame(index)
+        get_queue().finish()
+        times.append(time.perf_counter() - start)
+    times.sort()
+
+    device = get_context().devices[0]
+    return {
+        'params': params,
+        'device': f'{device.name} ({device.platform.name})',
+        'setup_s': setup_time,
+        'cold_start_s': cold_start,
+        'compile_s': compile_time,
+        'frames': frames,
+        'frame_mean_s': sum(times) / len(times),
+        'frame_median_s': times[len(times) // 2],
+        'frame_p90_s': times[min(len(times) - 1, int(len(times) * 0.9))],
+        'frame_min_s': times[0],
+        'host_peak_rss_bytes': _get_peak_rss_bytes(),
+        **({} if memory is None else memory()),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=__CURRENT_PATH__, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless benchmarks of the rendering package')
+    parser.add_argument('-k', '--filter', default='', help='run only cases containing this text')
+    parser.add_argument('-f', '--frames', type=int, default=None, help='timed frames per case')
+    parser.add_argument('-o', '--output', default=None, help='JSON file with the results')
+    parser.add_argument('--no-program-cache', action='store_true', help='compile programs from source')
+    parser.add_argument('--case', default=None, help=argparse.SUPPRESS)  # runs a single case in this process
+    args = parser.parse_args()
+
+    if args.case is not None:
+        print(json.dumps(run_case(args.case, args.frames)))
+        return
+
+    sys.path.insert(0, __CURRENT_PATH__)
+    import cases
+    names = [name for name in cases.get_cases() if args.filter in name]
+    environment = dict(os.environ)
+    if args.no_program_cache:
+        environment['RENDERTOY_NO_PROGRAM_CACHE'] = '1'
+    results = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'program_cache': not args.no_program_cache,
+        'cases': { },
+    }
+    for name in names:
+        command = [sys.executable, os.path.abspath(__file__), '--case', name]
+        if args.frames is not None:
+            command += ['--frames', str(args.frames)]
+        process = subprocess.run(command, capture_output=True, text=True, env=environment)
+        if process.returncode != 0:
+            print(f'{name:<28} failed\n{process.stderr}')
+            results['cases'][name] = {'error': process.stderr.strip().splitlines()[-1:]}
+            continue
+        measures = json.loads(process.stdout.strip().splitlines()[-1])
+        results['cases'][name] = measures
+        print(f"{name:<28} cold {measures['cold_start_s']:8.3f}s  compile {measures['compile_s']:7.3f}s  "
+              f"frame {measures['frame_median_s'] * 1000:9.2f}ms  rss {(measures['host_peak_rss_bytes'] or 0) / 2**20:7.1f}MiB")
+
+    output = args.output
+    if output is None:
+        output = os.path.join(__CURRENT_PATH__, 'results', datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results saved in {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,18 @@ from ._core import kernel_main, kernel_struct, create_buffer_from, create_buffer
     kernel_function, create_struct_from, create_image2d, Image, Buffer, \
     r_image1d_t, w_image1d_t, r_image2d_t, w_image2d_t, r_image3d_t, w_image3d_t,\
     make_float2, make_float3, make_float4, make_float4x4, translate, identity, scale, rotate, matmul, to_array, clear, \
-    perspective, look_at, normalize, dot
+    perspective, look_at, normalize, dot, configure_program_cache, configure_device, \
+    configure_profiling, get_profiler, KernelProfiler, start_tracing, stop_tracing, trace_span, Tracer, \
+    configure_autotuning, autotune, set_group_size, get_group_sizes
 
-from ._core import float2, float3, float4, int2, int3, int4, uint2, uint3, uint4, float4x4, Texture2D, create_texture2D
+from ._core import float2, float3, float4, int2, int3, int4, uint2, uint3, uint4, float4x4, Texture2D, create_texture2D, \
+    create_pool_buffer, release_pool_memory, get_memory_pool, TextureFormat, TextureLayout, \
+    generate_mipmaps
 
 from ._modeling import Mesh, WeldMode, SubdivisionMode, MeshVertex, manifold
 
-from ._loaders import load_obj
+from ._loaders import load_obj, load_texture, load_textures
 
-from ._presentation import create_presenter, Presenter, Event
+from ._presentation import create_presenter, create_offline_presenter, Presenter, Event
 
-from ._raster import Raster
\ No newline at end of file
+from ._raster import Raster, ScratchArena, CullMode, ShadingMode
\ No newline at end of file
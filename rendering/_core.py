@@ -2,42 +2,330 @@ import numpy as np
 import pyopencl as cl
 import pyopencl.array as cla
 import pyopencl.tools as cltools
+import pyopencl.cltypes as cltypes
+import bisect
+import collections
+import contextlib
+import functools
+import hashlib
 import inspect
+import json
 import math
+import os
+import time
 import typing
+from enum import IntEnum
 
 
-__ctx__ = cl.create_some_context()
-__queue__ = cl.CommandQueue(__ctx__)
-
-def create_buffer(count: int, dtype: np.dtype):
-    return cla.zeros(__queue__, (count,), dtype)
-
+__CONTEXT__ = None
+__QUEUE__ = None
+__DEVICE__ = None  # None lets pyopencl choose the device (PYOPENCL_CTX)
 __MAX_SIZE__ = 1024*1024*1024
-__MEMORY_POOL_BUFFER__ = create_buffer(__MAX_SIZE__, np.uint8)
+__PROFILING__ = os.environ.get('RENDERTOY_PROFILE') is not None  # kernel launches are timed with profiling events
+
+
+def configure_device(device: cl.Device = None, pool_size: int = None, profiling: bool = None):
+    """
+    Selects the device, the memory pool size (in bytes) and whether kernel launches are profiled from the start
+    (see configure_profiling). The context is created on the first device operation, so this must be called before that.
+    """
+    assert __CONTEXT__ is None, "Device can not be configured after the context was created"
+    global __DEVICE__, __MAX_SIZE__, __PROFILING__
+    if device is not None:
+        __DEVICE__ = device
+    if pool_size is not None:
+        __MAX_SIZE__ = pool_size
+    if profiling is not None:
+        __PROFILING__ = profiling
+
+
+def get_context() -> cl.Context:
+    global __CONTEXT__, __QUEUE__
+    if __CONTEXT__ is None:
+        __CONTEXT__ = cl.create_some_context() if __DEVICE__ is None else cl.Context([__DEVICE__])
+        # always able to profile so profiling can be switched at any moment, events are only read while profiling
+        __QUEUE__ = cl.CommandQueue(__CONTEXT__, properties=cl.command_queue_properties.PROFILING_ENABLE)
+    return __CONTEXT__
+
+
+def get_queue() -> cl.CommandQueue:
+    if __QUEUE__ is None:
+        get_context()
+    return __QUEUE__
+
+
+def has_device_extension(extension: str) -> bool:
+    return extension in get_context().devices[0].extensions.split()
+
+
+def is_profiling() -> bool:
+    return __PROFILING__
+
+
+def configure_profiling(enabled: bool = True):
+    """
+    Starts or stops timing kernel launches. Launches of the current frame are resolved when profiling stops.
+    """
+    global __PROFILING__
+    if __PROFILING__ and not enabled:
+        __PROFILER__.end_frame()
+    __PROFILING__ = enabled
+
+
+class KernelProfiler:
+    """
+    Device times of kernel launches grouped by kernel name and aggregated per frame. Events of the current frame are
+    resolved when the frame ends (presenters end frames automatically), only the last max_frames frames are kept.
+    At most __MAX_PENDING__ events are kept, older ones are resolved into the current frame before that.
+    """
+    __MAX_PENDING__ = 4096
+
+    def __init__(self, max_frames: int = 600):
+        self.pending = []  # (name, event) launched in the current frame and not resolved yet
+        self.frame = { }  # name -> (calls, device ns, queued to start ns) of resolved events in the current frame
+        self.frames = collections.deque(maxlen=max_frames)  # per frame, name -> (calls, device ns, queued to start ns)
+
+    def record(self, name: str, event: cl.Event):
+        self.pending.append((name, event))
+        if len(self.pending) >= KernelProfiler.__MAX_PENDING__:
+            self._resolve(len(self.pending) // 2)  # frames never ended, do not grow forever
+
+    def _resolve(self, count: int):
+        resolved, self.pending = self.pending[:count], self.pending[count:]
+        with trace_span('profiler_wait', 'sync'):
+            cl.wait_for_events([event for _, event in resolved])
+        for name, event in resolved:
+            profile = event.profile
+            calls, device, latency = self.frame.get(name, (0, 0, 0))
+            self.frame[name] = (calls + 1, device + profile.end - profile.start, latency + profile.start - profile.queued)
+
+    def end_frame(self):
+        if len(self.pending) > 0:
+            self._resolve(len(self.pending))
+        if len(self.frame) == 0:
+            return
+        self.frames.append(self.frame)
+        self.frame = { }
+
+    def reset(self):
+        self.pending = []
+        self.frame = { }
+        self.frames.clear()
+
+    def get_report(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        """
+        Per kernel, sorted by total device time: number of calls (in total and per frame), total and mean device time
+        per call, percentiles of the device time per frame and mean time waiting in queue, in milliseconds.
+        """
+        self.end_frame()
+        frames = len(self.frames)
+        report = { }
+        for name in set(name for frame in self.frames for name in frame):
+            per_frame = np.array([frame.get(name, (0, 0, 0)) for frame in self.frames], dtype=np.float64)
+            calls = int(per_frame[:, 0].sum())
+            frame_ms = per_frame[:, 1] * 1e-6
+            report[name] = {
+                'calls': calls,
+                'calls_per_frame': calls / frames,
+                'total_ms': float(frame_ms.sum()),
+                'mean_ms': float(frame_ms.sum()) / calls,
+                'frame_p50_ms': float(np.percentile(frame_ms, 50)),
+                'frame_p90_ms': float(np.percentile(frame_ms, 90)),
+                'frame_p99_ms': float(np.percentile(frame_ms, 99)),
+                'queued_ms': float(per_frame[:, 2].sum()) * 1e-6 / calls,
+            }
+        return dict(sorted(report.items(), key=lambda item: -item[1]['total_ms']))
+
+    def format_report(self) -> str:
+        lines = [f"{'kernel':<40}{'calls/frame':>12}{'total ms':>12}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"]
+        for name, k in self.get_report().items():
+            lines.append(f"{name:<40}{k['calls_per_frame']:>12.1f}{k['total_ms']:>12.3f}{k['mean_ms']:>10.4f}"
+                         f"{k['frame_p50_ms']:>10.4f}{k['frame_p90_ms']:>10.4f}{k['frame_p99_ms']:>10.4f}")
+        return '\n'.join(lines)
+
+
+__PROFILER__ = KernelProfiler()
+
+
+def get_profiler() -> KernelProfiler:
+    return __PROFILER__
+
+
+class Tracer:
+    """
+    Records host spans and kernel launches in a single timeline saved in Chrome trace format (chrome://tracing or
+    Perfetto). Kernel spans require profiling to be enabled when tracing starts (see configure_profiling).
+    """
+    def __init__(self):
+        self.host_spans = []  # (name, category, start ns, end ns) in perf_counter clock
+        self.kernels = []  # (name, event)
+        self.device_offset = None  # perf_counter minus device clock, in ns
+        if __PROFILING__:
+            marker = cl.enqueue_marker(get_queue())
+            marker.wait()
+            self.device_offset = time.perf_counter_ns() - marker.profile.end
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.host_spans.append((name, category, start, time.perf_counter_ns()))
+
+    def record(self, name: str, event: cl.Event):
+        if self.device_offset is not None:
+            self.kernels.append((name, event))
+
+    def get_trace_events(self) -> typing.List[dict]:
+        events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 0, 'args': {'name': 'host'}},
+            {'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 1, 'args': {'name': 'device'}},
+        ]
+        for name, category, start, end in self.host_spans:
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': 0, 'tid': 0,
+                           'ts': start / 1000, 'dur': (end - start) / 1000})
+        if len(self.kernels) > 0:
+            cl.wait_for_events([event for _, event in self.kernels])
+        for name, event in self.kernels:
+            profile = event.profile
+            events.append({'name': name, 'cat': 'kernel', 'ph': 'X', 'pid': 0, 'tid': 1,
+                           'ts': (profile.start + self.device_offset) / 1000, 'dur': (profile.end - profile.start) / 1000,
+                           'args': {'queued_us': (profile.start - profile.queued) / 1000}})
+        return events
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.get_trace_events(), 'displayTimeUnit': 'ms'}, f)
+
+
+__TRACER__ = None  # active tracer, None when tracing is off
+__NULL_SPAN__ = contextlib.nullcontext()
+
+
+def start_tracing() -> Tracer:
+    global __TRACER__
+    __TRACER__ = Tracer()
+    return __TRACER__
+
+
+def stop_tracing(path: str = None) -> Tracer:
+    """
+    Stops recording and returns the tracer, saving the trace first if a path is given.
+    """
+    global __TRACER__
+    tracer, __TRACER__ = __TRACER__, None
+    if tracer is not None and path is not None:
+        tracer.save(path)
+    return tracer
+
+
+def trace_span(name: str, category: str = 'host'):
+    """
+    Context manager recording a host span if tracing, a shared no-op context otherwise.
+    """
+    if __TRACER__ is None:
+        return __NULL_SPAN__
+    return __TRACER__.span(name, category)
+
+
+def traced(name: str, category: str = 'host'):
+    """
+    Decorator recording every call of a function as a host span while tracing.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if __TRACER__ is None:
+                return f(*args, **kwargs)
+            with __TRACER__.span(name, category):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def __getattr__(name):
+    # __ctx__ and __queue__ are created on first access
+    if name == '__ctx__':
+        return get_context()
+    if name == '__queue__':
+        return get_queue()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__CACHE_DIR__ = os.environ.get('RENDERTOY_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'rendertoy'))
+__PROGRAM_CACHE_ENABLED__ = os.environ.get('RENDERTOY_NO_PROGRAM_CACHE') is None
+
+
+def configure_program_cache(directory: str = None, enabled: bool = True):
+    """
+    Sets the folder where compiled program binaries (and other cached data) are stored and reused across runs.
+    """
+    global __CACHE_DIR__, __PROGRAM_CACHE_ENABLED__
+    if directory is not None:
+        __CACHE_DIR__ = directory
+    __PROGRAM_CACHE_ENABLED__ = enabled
+
+
+def get_cache_dir(*subfolders) -> str:
+    return os.path.join(__CACHE_DIR__, *subfolders)
+
+
+def _program_cache_key(source: str, options: typing.List[str]):
+    device = get_context().devices[0]
+    key = hashlib.sha256()
+    for part in (source, device.name, device.vendor, device.version, device.driver_version,
+                 device.platform.name, device.platform.version, ' '.join(options), cl.VERSION_TEXT):
+        key.update(part.encode('utf8'))
+        key.update(b'\0')
+    return key.hexdigest()
+
+
+def build_program(source: str, options: typing.List[str] = ()):
+    """
+    Builds an OpenCL program for the device in use. Binaries are cached on disk keyed by the source,
+    the device, the driver version and the build options, so next runs skip the compilation.
+    """
+    options = list(options)
+    if not __PROGRAM_CACHE_ENABLED__:
+        return cl.Program(get_context(), source).build(options=options)
+    path = os.path.join(get_cache_dir('programs'), _program_cache_key(source, options) + '.bin')
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                binary = f.read()
+            return cl.Program(get_context(), get_context().devices[:1], [binary]).build(options=options)
+        except (OSError, cl.Error):
+            pass  # corrupted or incompatible binary, rebuild from source
+    program = cl.Program(get_context(), source).build(options=options)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(program.binaries[0])
+        os.replace(temp_path, path)  # atomic, concurrent workers never see partial binaries
+    except OSError:
+        pass  # a read-only cache folder only disables the reuse
+    return program
 
 
-def get_buffer_ptr():
-    # Create kernel to retrieve buffer ptr
-    program = cl.Program(__ctx__,
-                         """
-    __kernel void get_ptr(__global char* ptr, __global unsigned long* ptr_store) {
-        ptr_store[0] = (unsigned long)ptr;
-    }
-                         """).build()
-    kernel = program.get_ptr
-    ptr_store = cla.to_device(__queue__, np.zeros((1,), np.int64))
-    kernel(__queue__, (1,), None, __MEMORY_POOL_BUFFER__.data, ptr_store.data)
-    return int(ptr_store.map_to_host())
+def create_buffer(count: int, dtype: np.dtype):
+    return cla.zeros(get_queue(), (count,), dtype)
 
 
-test1 = get_buffer_ptr()
-test2 = get_buffer_ptr()
+def get_buffer_ptr(buffer: cla.Array):
+    ptr_store = create_buffer(1, np.uint64)
+    __GET_BUFFER_PTR__[1](buffer, ptr_store)
+    return int(ptr_store.get()[0])
 
 
 __code__ = """
 #define float4x4 float16
 
+#ifdef cl_khr_int64_extended_atomics
+#pragma OPENCL EXTENSION cl_khr_int64_extended_atomics : enable
+#endif
+
 float4x4 transpose( float4x4 m )
 {
     float4x4 t;
@@ -87,14 +375,6 @@ float4 mul(float4 v, float4x4 m) {
     return (float4)(dot(v, m.even.even), dot(v, m.odd.even), dot(v, m.even.odd), dot(v, m.odd.odd));    
 }
 
-"""+\
-f"__constant unsigned long memory_pool_ptr = {get_buffer_ptr()};"+\
-"""
-
-#define wrap_coord(c) (fmod(fmod(c, 1.0f) + 1.0f, 1.0f))
-
-#define sample2D(texture, c) (((float4*)(memory_pool_ptr + (texture).offset + 16*((int)(wrap_coord((c).y) * (texture).height) * (texture).width + (int)(wrap_coord((c).x) * (texture).width))))[0]) 
-
 """
 
 float2 = cltools.get_or_register_dtype('float2')
@@ -195,6 +475,9 @@ __OBJECT_TYPE_TO_CLTYPE__ = {
 }
 
 
+__PYTHON_SCALAR_TYPES__ = { int: np.int32, float: np.float32 }  # python numeric annotations in the 32 bit form
+
+
 def _get_annotation_as_cltype(annotation):
     if annotation is None:
         return "void"
@@ -205,6 +488,7 @@ def _get_annotation_as_cltype(annotation):
         annotation = annotation[0]
     if isinstance(annotation, str):  # object types
         return annotation
+    annotation = __PYTHON_SCALAR_TYPES__.get(annotation, annotation)
     return ("__global " if is_pointer else "")+cltools.dtype_to_ctype(annotation) +("*" if is_pointer else "")
 
 
@@ -244,50 +528,363 @@ def build_kernel_function(name, arguments, return_type, body):
 __MEMORY_POOL__ = None
 
 
-def build_kernel_main(name, arguments, body):
+class ProgramRegistry:
+    """
+    Keeps track of the kernels declared in the accumulated source that were not compiled yet.
+    All pending kernels are compiled together in a single program the first time any of them is requested,
+    and every kernel declared up to that source version reuses that program.
+    """
+    def __init__(self):
+        self.pending = set()
+        self.programs = { }  # kernel name -> compiled program containing it
+        self.source_keys = { }  # kernel name -> hash of the source and build options of its program
+        self.kernels = { }
+        self.dispatchers = { }  # kernel name -> dispatcher of kernels declared with build_kernel_main
+
+    def declare(self, name):
+        self.pending.add(name)
+        self.kernels.pop(name, None)
+
+    def build_pending(self):
+        if len(self.pending) == 0:
+            return
+        options = []
+        with trace_span('build_program', 'build'):
+            program = build_program(__code__, options)
+        key = hashlib.sha256('\0'.join([__code__, *options]).encode('utf8')).hexdigest()
+        for name in self.pending:
+            self.programs[name] = program
+            self.source_keys[name] = key
+        self.pending.clear()
+
+    def get_kernel(self, name) -> cl.Kernel:
+        if name not in self.kernels:
+            if name in self.pending:
+                self.build_pending()
+            self.kernels[name] = cl.Kernel(self.programs[name], name)
+        return self.kernels[name]
+
+
+__PROGRAM_REGISTRY__ = ProgramRegistry()
+
+
+def build_kernel_main(name, arguments, body, group_size: int = None):
+    """
+    Declares a kernel with a linear layout of threads. If group_size is given, threads are launched in work-groups of
+    exactly that size (needed by kernels sharing local memory within a group), otherwise the size can be overridden or
+    tuned per device (see set_group_size and configure_autotuning).
+    Kernels can also be launched indirectly (see Dispatcher.indirect) with the number of threads read from the device.
+    """
     global __code__
-    signature = ', '.join([_get_annotation_as_cltype(annotation)+" "+ arg_name for arg_name, annotation in arguments.items()] + ['int number_of_threads'])
+    signature = ', '.join([_get_annotation_as_cltype(annotation)+" "+ arg_name for arg_name, annotation in arguments.items()] + ['int number_of_threads', '__global const int* thread_count'])
     __code__ += f"""
     __kernel void {name}({signature}) {{
     int thread_id = get_global_id(0);
     if (thread_id >= number_of_threads) return; // automatically skip threads outside range
+    if (thread_count != 0 && thread_id >= *thread_count) return; // skip threads outside the range counted in device
     {body}
     }}
         """
-    program = None
+    __PROGRAM_REGISTRY__.declare(name)
 
-    max_group_size = 32 #__ctx__.devices[0].get_info(cl.device_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE)
+    if group_size is not None:
+        dispatcher = Dispatcher(name, arguments, group_size, fixed_group_size=True)
+    else:
+        # tuned or overridden sizes are applied on the first launch (see configure_autotuning)
+        dispatcher = Dispatcher(name, arguments, __DEFAULT_GROUP_SIZE__)
+    __PROGRAM_REGISTRY__.dispatchers[name] = dispatcher
+    return dispatcher
 
-    class Dispatcher:
-        def __init__(self):
-            pass
 
-        def __getitem__(self, num_threads):
-            if isinstance(num_threads, list) or isinstance(num_threads, tuple):
-                num_threads = math.prod(num_threads)
+def _resolve_pointer_arg(a):
+    if isinstance(a, cla.Array):
+        return a.data  # case of a pointer, pass the buffer
+    return a
+
 
-            def resolve_arg(a, annotation):
-                if isinstance(a, cla.Array):
-                    if isinstance(annotation, list):
-                        a = a.data  # case of a pointer, pass the buffer
-                    else:
-                        a = a.get()  # pass the numpy array as a value transfer.
-                if isinstance(a, int):
-                    a = np.int32(a)  # treat python numeric values in the 32 bit form
-                if isinstance(a, float):
-                    a = np.float32(a)  # treat python numeric values in the 32 bit form
-                return a
+def _resolve_value_arg(a):
+    if isinstance(a, cla.Array):
+        return _get_host_mirror(a)  # pass the numpy array as a value transfer.
+    if isinstance(a, int):
+        return np.int32(a)  # treat python numeric values in the 32 bit form
+    if isinstance(a, float):
+        return np.float32(a)  # treat python numeric values in the 32 bit form
+    return a
 
-            def dispatch_call(*args):
-                nonlocal program
-                if program is None:
-                    program = cl.Program(__ctx__, __code__).build()
-                kernel = program.__getattr__(name)
-                kernel(__queue__, ((num_threads // max_group_size + 1)*max_group_size,), (max_group_size,), *([resolve_arg(a, v) for a, (k, v) in zip(args, arguments.items())] + [np.int32(num_threads)]))
 
-            return dispatch_call
+@functools.lru_cache(maxsize=None)
+def _get_scalar_arg_resolver(dtype: np.dtype):
+    scalar_type = dtype.type
 
-    return Dispatcher()
+    def resolve(a):
+        if isinstance(a, (int, float)):
+            return scalar_type(a)  # python numeric values are passed with the declared size
+        return _resolve_value_arg(a)
+    return resolve
+
+
+def _get_arg_resolver(annotation):
+    if isinstance(annotation, list):
+        return _resolve_pointer_arg
+    if isinstance(annotation, str):  # object types
+        return _resolve_value_arg
+    dtype = np.dtype(__PYTHON_SCALAR_TYPES__.get(annotation, annotation))
+    return _get_scalar_arg_resolver(dtype) if dtype.kind in 'iuf' else _resolve_value_arg
+
+
+__UNSET_ARG__ = object()
+
+
+def _get_arg_key(a):
+    if isinstance(a, (np.ndarray, np.generic)):
+        return a.tobytes()  # numpy values are mutable, compare the content
+    return a
+
+
+class BoundLaunch:
+    """
+    Launch of a kernel with a fixed number of threads. Work sizes are computed once and launching only
+    sets the kernel arguments that changed since the last launch of the same kernel.
+    """
+    def __init__(self, dispatcher: 'Dispatcher', num_threads: int, thread_count: cla.Array = None):
+        self.dispatcher = dispatcher
+        self.num_threads = np.int32(num_threads)
+        self.thread_count = thread_count
+        self._set_group_size(dispatcher.group_size)
+
+    def _set_group_size(self, group_size: int):
+        self.global_size = (max(1, (int(self.num_threads) + group_size - 1) // group_size) * group_size,)
+        self.local_size = (group_size,)
+
+    def __call__(self, *args):
+        dispatcher = self.dispatcher
+        kernel = dispatcher.get_kernel()
+        if self.local_size[0] != dispatcher.group_size:
+            self._set_group_size(dispatcher.group_size)  # tuned or overridden since this launch was bound
+        last_keys = dispatcher.last_keys
+        for i, (a, resolve) in enumerate(zip(args, dispatcher.arg_resolvers)):
+            if resolve is _resolve_pointer_arg:
+                _drop_host_mirror(a)  # the kernel might write the struct
+                if a is last_keys[i]:
+                    continue  # same buffer bound
+            a = resolve(a)
+            key = _get_arg_key(a)
+            if key is last_keys[i] or (isinstance(key, bytes) and key == last_keys[i]):
+                continue
+            kernel.set_arg(i, a)
+            last_keys[i] = args[i] if resolve is _resolve_pointer_arg else key
+        if last_keys[-2] != self.num_threads:
+            kernel.set_arg(len(last_keys) - 2, self.num_threads)
+            last_keys[-2] = self.num_threads
+        if last_keys[-1] is not self.thread_count:
+            kernel.set_arg(len(last_keys) - 1, None if self.thread_count is None else self.thread_count.data)
+            last_keys[-1] = self.thread_count
+        if dispatcher.tuner is not None:
+            event = dispatcher.tuner.launch(kernel, int(self.num_threads))
+        else:
+            event = cl.enqueue_nd_range_kernel(get_queue(), kernel, self.global_size, self.local_size)
+        if __PROFILING__:
+            __PROFILER__.record(dispatcher.name, event)
+        if __TRACER__ is not None:
+            __TRACER__.record(dispatcher.name, event)
+        return event
+
+
+class Dispatcher:
+    __MAX_BOUND_LAUNCHES__ = 64
+
+    def __init__(self, name, arguments, group_size, fixed_group_size: bool = False):
+        self.name = name
+        self.arguments = arguments
+        self.group_size = group_size
+        self.fixed_group_size = fixed_group_size  # kernels sharing local memory are never tuned
+        self.tuner = None  # times candidate group sizes in next launches while autotuning
+        self.arg_resolvers = [_get_arg_resolver(annotation) for annotation in arguments.values()]
+        self.last_keys = [__UNSET_ARG__] * (len(arguments) + 2)  # last value set for each argument, the number of threads and the thread count buffer
+        self.kernel = None
+        self.launches = { }
+
+    def get_kernel(self) -> cl.Kernel:
+        if self.kernel is None:
+            self.kernel = __PROGRAM_REGISTRY__.get_kernel(self.name)
+            if not self.fixed_group_size:
+                self._resolve_group_size()
+        return self.kernel
+
+    def get_max_group_size(self) -> int:
+        return self.get_kernel().get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, get_context().devices[0])
+
+    def get_tuning_key(self) -> str:
+        # tuned sizes are only valid for the same kernel code and build options
+        self.get_kernel()
+        return f'{self.name}:{__PROGRAM_REGISTRY__.source_keys[self.name]}'
+
+    def _resolve_group_size(self):
+        # manual overrides first, then sizes tuned in previous runs, otherwise tuned now if enabled
+        tuned_group_sizes = _get_tuned_group_sizes()
+        if self.name in __GROUP_SIZE_OVERRIDES__:
+            self.group_size = __GROUP_SIZE_OVERRIDES__[self.name]
+        elif self.get_tuning_key() in tuned_group_sizes:
+            self.group_size = tuned_group_sizes[self.get_tuning_key()]
+        elif __AUTOTUNING__:
+            self.autotune()
+        self.group_size = min(self.group_size, self.get_max_group_size())  # the limit depends on the compiled kernel
+
+    def autotune(self):
+        """
+        Times candidate group sizes in the next launches of the kernel and keeps the fastest one for the device.
+        """
+        assert not self.fixed_group_size, f"Group size of {self.name} is fixed"
+        self.tuner = GroupSizeTuner(self, self.get_kernel())
+
+    def __getitem__(self, num_threads) -> BoundLaunch:
+        if isinstance(num_threads, list) or isinstance(num_threads, tuple):
+            num_threads = math.prod(num_threads)
+        launch = self.launches.get(num_threads)
+        if launch is None:
+            if len(self.launches) >= Dispatcher.__MAX_BOUND_LAUNCHES__:
+                self.launches.clear()  # thread counts varying every frame, do not grow forever
+            launch = self.launches[num_threads] = BoundLaunch(self, num_threads)
+        return launch
+
+    def indirect(self, max_threads: int, thread_count: cla.Array) -> BoundLaunch:
+        """
+        Launch of max_threads threads where only the first thread_count[0] run. The count is read by the kernel from
+        the device, so it can be produced by a previous kernel without synchronizing with the host.
+        """
+        key = (max_threads, id(thread_count))
+        launch = self.launches.get(key)
+        if launch is None:
+            if len(self.launches) >= Dispatcher.__MAX_BOUND_LAUNCHES__:
+                self.launches.clear()
+            launch = self.launches[key] = BoundLaunch(self, max_threads, thread_count)
+        return launch
+
+
+__DEFAULT_GROUP_SIZE__ = 32
+__AUTOTUNING__ = os.environ.get('RENDERTOY_AUTOTUNE') is not None
+__GROUP_SIZE_OVERRIDES__ = { }  # kernel name -> group size set manually
+__TUNED_GROUP_SIZES__ = None  # kernel name and source key -> group size tuned for the device, loaded from the cache folder
+
+
+def configure_autotuning(enabled: bool = True):
+    """
+    Enables tuning the group size of kernels without a size tuned for the device in previous runs. Every kernel is
+    then launched with candidate sizes (synchronizing with the device) during its first launches.
+    """
+    global __AUTOTUNING__
+    __AUTOTUNING__ = enabled
+
+
+def set_group_size(kernel: typing.Union['Dispatcher', str], group_size: int):
+    """
+    Overrides the group size of a kernel (dispatcher or name), taking precedence over the tuned size.
+    The size must be positive and not exceed the limit of the compiled kernel on the device.
+    """
+    name = kernel if isinstance(kernel, str) else kernel.name
+    dispatcher = __PROGRAM_REGISTRY__.dispatchers.get(name)
+    assert dispatcher is None or not dispatcher.fixed_group_size, f"Group size of {name} is fixed"
+    assert group_size > 0, f"Group size of {name} must be positive"
+    if dispatcher is not None:
+        limit = dispatcher.get_max_group_size()
+        assert group_size <= limit, f"Group size of {name} can not exceed {limit} in this device"
+    __GROUP_SIZE_OVERRIDES__[name] = group_size
+    if dispatcher is not None:
+        dispatcher.tuner = None
+        dispatcher.group_size = group_size
+
+
+def autotune(*kernels: typing.Union['Dispatcher', str]):
+    """
+    Tunes again the group size of the given kernels (all declared kernels with free group size if none) in their
+    next launches, replacing the sizes stored for the device.
+    """
+    dispatchers = __PROGRAM_REGISTRY__.dispatchers
+    names = [k if isinstance(k, str) else k.name for k in kernels] or \
+            [name for name, d in dispatchers.items() if not d.fixed_group_size and name not in __GROUP_SIZE_OVERRIDES__]
+    for name in names:
+        dispatchers[name].autotune()
+
+
+def get_group_sizes() -> typing.Dict[str, int]:
+    return {name: d.group_size for name, d in __PROGRAM_REGISTRY__.dispatchers.items()}
+
+
+def _group_sizes_path():
+    device = get_context().devices[0]
+    key = hashlib.sha256()
+    for part in (device.name, device.vendor, device.version, device.driver_version, device.platform.name):
+        key.update(part.encode('utf8'))
+        key.update(b'\0')
+    return os.path.join(get_cache_dir('group_sizes'), key.hexdigest() + '.json')
+
+
+def _get_tuned_group_sizes() -> typing.Dict[str, int]:
+    global __TUNED_GROUP_SIZES__
+    if __TUNED_GROUP_SIZES__ is None:
+        try:
+            with open(_group_sizes_path()) as f:
+                __TUNED_GROUP_SIZES__ = {name: int(size) for name, size in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            __TUNED_GROUP_SIZES__ = { }
+    return __TUNED_GROUP_SIZES__
+
+
+def _store_tuned_group_size(key: str, group_size: int):
+    sizes = _get_tuned_group_sizes()
+    sizes[key] = group_size
+    path = _group_sizes_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(sizes, f, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+    except OSError:
+        pass  # a read-only cache folder only disables the reuse
+
+
+class GroupSizeTuner:
+    """
+    Launches a kernel cycling through candidate group sizes (powers of two up to the kernel limit, and the preferred
+    multiple of the device). Each launch is timed alone and normalized by its threads, after __SAMPLES__ launches per
+    candidate the fastest one is set in the dispatcher and stored for the device.
+    """
+    __SAMPLES__ = 3
+    __MAX_CANDIDATE__ = 1024
+
+    def __init__(self, dispatcher: 'Dispatcher', kernel: cl.Kernel):
+        device = get_context().devices[0]
+        limit = min(GroupSizeTuner.__MAX_CANDIDATE__,
+                    kernel.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device))
+        preferred = kernel.get_work_group_info(cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE, device)
+        candidates = {1 << i for i in range(limit.bit_length())}
+        if preferred <= limit:
+            candidates.add(preferred)
+        self.dispatcher = dispatcher
+        self.candidates = sorted(candidates)
+        self.times = {size: [] for size in self.candidates}
+        self.next = 0
+
+    def launch(self, kernel: cl.Kernel, num_threads: int) -> cl.Event:
+        group_size = self.candidates[self.next]
+        self.next = (self.next + 1) % len(self.candidates)
+        global_size = max(1, (num_threads + group_size - 1) // group_size) * group_size
+        queue = get_queue()
+        queue.finish()  # time the launch alone
+        start = time.perf_counter()
+        event = cl.enqueue_nd_range_kernel(queue, kernel, (global_size,), (group_size,))
+        event.wait()
+        elapsed = time.perf_counter() - start
+        if __PROFILING__:
+            elapsed = (event.profile.end - event.profile.start) * 1e-9
+        self.times[group_size].append(elapsed / max(1, num_threads))
+        if all(len(times) >= GroupSizeTuner.__SAMPLES__ for times in self.times.values()):
+            best = min(self.candidates, key=lambda size: min(self.times[size]))
+            self.dispatcher.group_size = best
+            self.dispatcher.tuner = None
+            _store_tuned_group_size(self.dispatcher.get_tuning_key(), best)
+        return event
 
 
 def kernel_main(f):
@@ -299,37 +896,289 @@ def kernel_main(f):
     return build_kernel_main(name, arguments, body)
 
 
+__VECTOR_TYPES__ = set(cltypes.vec_types.values())
+
+
+def _get_c_alignment(dtype: np.dtype):
+    if dtype.subdtype is not None:
+        return _get_c_alignment(dtype.subdtype[0])
+    if dtype.fields is None or dtype in __VECTOR_TYPES__:
+        return dtype.itemsize  # scalars and vectors are aligned to their size (3 components vectors use 4)
+    return max(_get_c_alignment(d) for d, *_ in dtype.fields.values())
+
+
+def _match_dtype_to_c_struct(name: str, dtype: np.dtype):
+    """
+    Same as pyopencl.tools.match_dtype_to_c_struct but the layout is resolved on host following OpenCL C alignment
+    rules, instead of compiling a kernel on the device.
+    """
+    offsets = []
+    c_fields = []
+    size = 0
+    for field_name, (field_dtype, _) in dtype.fields.items():
+        alignment = _get_c_alignment(field_dtype)
+        size = (size + alignment - 1) // alignment * alignment
+        offsets.append(size)
+        size += field_dtype.itemsize
+        if field_dtype.subdtype is not None:
+            array_dtype, dims = field_dtype.subdtype
+            c_fields.append(f"  {cltools.dtype_to_ctype(array_dtype)} {field_name}{''.join(f'[{d}]' for d in dims)};")
+        else:
+            c_fields.append(f"  {cltools.dtype_to_ctype(field_dtype)} {field_name};")
+    alignment = _get_c_alignment(dtype)
+    size = (size + alignment - 1) // alignment * alignment
+    c_decl = "typedef struct {\n" + "\n".join(c_fields) + f"\n}} {name};\n\n"
+    dtype = np.dtype({
+        'names': list(dtype.fields.keys()),
+        'formats': [d for d, *_ in dtype.fields.values()],
+        'offsets': offsets,
+        'itemsize': size
+    })
+    return dtype, c_decl
+
+
 def kernel_struct(cls):
     fields = cls.__dict__['__annotations__']
     assert all(k in fields.keys() for k in cls.__dict__.keys() if k[0] != "_"), "A public field was declared without annotation"
-    dtype = np.dtype([(k, v) for k,v in fields.items()])
-    dtype, cltype = cltools.match_dtype_to_c_struct(__ctx__.devices[0], cls.__name__, dtype)
+    dtype = np.dtype([(k, __PYTHON_SCALAR_TYPES__.get(v, v)) for k,v in fields.items()])
+    dtype, cltype = _match_dtype_to_c_struct(cls.__name__, dtype)
     global __code__
     __code__ += cltype
     cltools.get_or_register_dtype(cls.__name__, dtype)
     return dtype
 
 
+class TextureFormat(IntEnum):
+    FLOAT4 = 0
+    RGBA8 = 1
+    HALF4 = 2
+    RG16F = 3
+    R32F = 4
+
+
+# numpy type and components of a texel in host for each format (as exposed when mapping the texture memory)
+__TEXEL_FORMATS__ = {
+    TextureFormat.FLOAT4: (float4, 1),
+    TextureFormat.RGBA8: (np.uint8, 4),
+    TextureFormat.HALF4: (np.float16, 4),
+    TextureFormat.RG16F: (np.float16, 2),
+    TextureFormat.R32F: (np.float32, 1),
+}
+
+
+class TextureLayout(IntEnum):
+    # values are the log2 of the block side
+    LINEAR = 0
+    TILED4X4 = 2
+    TILED8X8 = 3
+
+
+__MAX_TEXTURE_LEVELS__ = 16
+
+
 @kernel_struct
 class Texture2D:
     width: np.int32
     height: np.int32
-    offset: np.int32
+    offset: np.uint64  # byte offset in the memory pool, pools can be larger than 2GB (see configure_device)
+    format: np.int32
+    levels: np.int32
+    layout: np.int32
+    level_offsets: (np.int32, __MAX_TEXTURE_LEVELS__)  # byte offset of each mip level from the texture offset
+    memory: np.uint64  # device address of the memory pool, kept out of the program source to reuse binaries
 
 
+__code__ += """
+#define wrap_coord(c) (fmod(fmod(c, 1.0f) + 1.0f, 1.0f))
 
+int2 texture_level_size(Texture2D texture, int level)
+{
+    return (int2)(max(1, texture.width >> level), max(1, texture.height >> level));
+}
+
+int texture_texel_index(Texture2D texture, int x, int y, int level)
+{
+    int width = texture_level_size(texture, level).x;
+    if (texture.layout == 0) // LINEAR
+        return y * width + x;
+    // texels of each block are contiguous, blocks are stored row by row
+    int block_bits = texture.layout;
+    int block_mask = (1 << block_bits) - 1;
+    int blocks_per_row = (width + block_mask) >> block_bits;
+    int block = (y >> block_bits) * blocks_per_row + (x >> block_bits);
+    return (block << (2 * block_bits)) + ((y & block_mask) << block_bits) + (x & block_mask);
+}
+
+float4 fetch2DLod(Texture2D texture, int x, int y, int level)
+{
+    int index = texture_texel_index(texture, x, y, level);
+    __global uchar* texels = (__global uchar*)(texture.memory + texture.offset + texture.level_offsets[level]);
+    switch (texture.format)
+    {
+        case 1: // RGBA8
+            return convert_float4(((__global uchar4*)texels)[index]) * (1.0f / 255.0f);
+        case 2: // HALF4
+            return vload_half4(index, (__global half*)texels);
+        case 3: // RG16F
+            return (float4)(vload_half2(index, (__global half*)texels), 0.0f, 1.0f);
+        case 4: // R32F
+            return (float4)(((__global float*)texels)[index], 0.0f, 0.0f, 1.0f);
+        default: // FLOAT4
+            return ((__global float4*)texels)[index];
+    }
+}
+
+void store2DLod(Texture2D texture, int x, int y, int level, float4 value)
+{
+    int index = texture_texel_index(texture, x, y, level);
+    __global uchar* texels = (__global uchar*)(texture.memory + texture.offset + texture.level_offsets[level]);
+    switch (texture.format)
+    {
+        case 1: // RGBA8
+            ((__global uchar4*)texels)[index] = convert_uchar4_sat_rte(value * 255.0f);
+            break;
+        case 2: // HALF4
+            vstore_half4_rte(value, index, (__global half*)texels);
+            break;
+        case 3: // RG16F
+            vstore_half2_rte(value.xy, index, (__global half*)texels);
+            break;
+        case 4: // R32F
+            ((__global float*)texels)[index] = value.x;
+            break;
+        default: // FLOAT4
+            ((__global float4*)texels)[index] = value;
+    }
+}
+
+float4 fetch2D(Texture2D texture, int x, int y)
+{
+    return fetch2DLod(texture, x, y, 0);
+}
+
+float4 sample2D(Texture2D texture, float2 c)
+{
+    int x = min(texture.width - 1, (int)(wrap_coord(c.x) * texture.width));
+    int y = min(texture.height - 1, (int)(wrap_coord(c.y) * texture.height));
+    return fetch2D(texture, x, y);
+}
+
+float4 sample2DBilinear(Texture2D texture, float2 c, int level)
+{
+    int2 size = texture_level_size(texture, level);
+    float2 p = (float2)(wrap_coord(c.x) * size.x, wrap_coord(c.y) * size.y) - 0.5f;
+    float2 f = floor(p);
+    float2 w = p - f;
+    int x0 = ((int)f.x + size.x) % size.x;
+    int y0 = ((int)f.y + size.y) % size.y;
+    int x1 = (x0 + 1) % size.x;
+    int y1 = (y0 + 1) % size.y;
+    float4 top = mix(fetch2DLod(texture, x0, y0, level), fetch2DLod(texture, x1, y0, level), w.x);
+    float4 bottom = mix(fetch2DLod(texture, x0, y1, level), fetch2DLod(texture, x1, y1, level), w.x);
+    return mix(top, bottom, w.y);
+}
+
+// Trilinear sampling at a level of detail (0 is the full resolution level)
+float4 sample2DLod(Texture2D texture, float2 c, float lod)
+{
+    lod = clamp(lod, 0.0f, (float)(texture.levels - 1));
+    int level0 = (int)lod;
+    int level1 = min(level0 + 1, texture.levels - 1);
+    return mix(sample2DBilinear(texture, c, level0), sample2DBilinear(texture, c, level1), lod - level0);
+}
+
+// Trilinear sampling with the level of detail selected from the screen derivatives of the coordinates
+float4 sample2DGrad(Texture2D texture, float2 c, float2 dcdx, float2 dcdy)
+{
+    float2 size = (float2)(texture.width, texture.height);
+    float rho = max(length(dcdx * size), length(dcdy * size));
+    return sample2DLod(texture, c, log2(max(rho, 1e-8f)));
+}
+"""
+
+
+__GENERATE_MIP_LEVEL__ = build_kernel_main(
+    name='GenerateMipLevel',
+    arguments={'texture': Texture2D, 'level': np.int32},
+    body="""
+    int2 size = texture_level_size(texture, level);
+    int2 parent_size = texture_level_size(texture, level - 1);
+    int x = thread_id % size.x;
+    int y = thread_id / size.x;
+    // box filter over the 2x2 texels of the parent level (clamped for odd or degenerated sizes)
+    int x0 = min(2 * x, parent_size.x - 1);
+    int y0 = min(2 * y, parent_size.y - 1);
+    int x1 = min(2 * x + 1, parent_size.x - 1);
+    int y1 = min(2 * y + 1, parent_size.y - 1);
+    float4 value = (fetch2DLod(texture, x0, y0, level - 1) + fetch2DLod(texture, x1, y0, level - 1) +
+                    fetch2DLod(texture, x0, y1, level - 1) + fetch2DLod(texture, x1, y1, level - 1)) * 0.25f;
+    store2DLod(texture, x, y, level, value);
+    """
+)
+
+
+__GET_BUFFER_PTR__ = build_kernel_main(
+    name='GetBufferPtr',
+    arguments={'ptr': [np.int8], 'ptr_store': [np.uint64]},
+    body="""
+    ptr_store[0] = (ulong)ptr;
+    """,
+    group_size=1
+)
 
 
 def create_buffer_from(ary: np.ndarray):
-    return cla.to_device(__queue__, ary)
+    return cla.to_device(get_queue(), ary)
+
+
+def read_buffer_async(b: cla.Array, out: np.ndarray):
+    """
+    Enqueues a non-blocking copy of a buffer into a host array. The returned event must be waited before reading out.
+    """
+    return cl.enqueue_copy(get_queue(), out, b.base_data, src_offset=b.offset, is_blocking=False)
+
+
+def write_buffer_async(b: cla.Array, ary: np.ndarray):
+    """
+    Enqueues a non-blocking copy of a host array into a buffer. The host array is retained until the copy completes.
+    """
+    return cl.enqueue_copy(get_queue(), b.base_data, ary, dst_offset=b.offset, is_blocking=False)
+
+
+def _set_host_mirror(a: cla.Array, value: np.ndarray):
+    a._host_mirror = np.array(value, dtype=a.dtype).reshape(a.shape)
+
+
+def _drop_host_mirror(a):
+    # device writes (kernels through pointers, clear) invalidate the mirror, next by-value use reads the struct once
+    if getattr(a, '_host_mirror', None) is not None:
+        a._host_mirror = None
+
+
+def _get_host_mirror(a: cla.Array):
+    """
+    Host copy of a struct value passed by value to kernels. It is refreshed every time the struct is written through
+    mapped, so dispatches never read the struct back from the device. Binding the struct to a pointer parameter or
+    clearing it drops the mirror, so only the first by-value use after a possible device write requires a transfer.
+    """
+    mirror = getattr(a, '_host_mirror', None)
+    if mirror is None:
+        mirror = a.get()
+        _set_host_mirror(a, mirror)
+    return a._host_mirror
 
 
 def create_struct(dtype: np.dtype):
-    return cla.zeros(__queue__, 1, dtype)[0]
+    s = cla.zeros(get_queue(), 1, dtype)[0]
+    _set_host_mirror(s, np.zeros((), dtype))
+    return s
 
 
 def create_struct_from(ary: np.ndarray):
-    return cla.to_device(__queue__, ary.item())
+    s = cla.to_device(get_queue(), ary.item())
+    if s.dtype == ary.dtype and s.size == ary.size:
+        _set_host_mirror(s, ary)
+    return s
 
 
 __IMAGE_FORMATS__ = {
@@ -370,7 +1219,7 @@ Buffer = cl.Buffer
 
 def create_image2d(width: int, height: int, dtype: np.dtype):
     assert dtype in __IMAGE_FORMATS__, "Unsupported dtype for image format"
-    return cl.Image(__ctx__, cl.mem_flags.READ_WRITE, __IMAGE_FORMATS__[dtype], shape=(width, height))
+    return cl.Image(get_context(), cl.mem_flags.READ_WRITE, __IMAGE_FORMATS__[dtype], shape=(width, height))
 
 
 def clear(b, value = np.float32(0)):
@@ -379,20 +1228,40 @@ def clear(b, value = np.float32(0)):
     if not isinstance(value, np.ndarray):
         value = np.array(value)
     if isinstance(b, cla.Array):
+        _drop_host_mirror(b)
         b = b.base_data
     if isinstance(b, Buffer):
-        cl.enqueue_fill_buffer(__queue__, b, value, 0, b.size)
+        cl.enqueue_fill_buffer(get_queue(), b, value, 0, b.size)
     else:
         if math.prod(value.shape) <= 1:
             value = np.array([value]*4)
-        cl.enqueue_fill_image(__queue__, b, value, (0,0,0), (b.width, max(1, b.height), max(1, b.depth)))
+        cl.enqueue_fill_image(get_queue(), b, value, (0,0,0), (b.width, max(1, b.height), max(1, b.depth)))
+
+
+def _untile_texels(tiled: np.ndarray, height: int, width: int):
+    blocks_y, blocks_x, block, _, *texel_shape = tiled.shape
+    linear = tiled.swapaxes(1, 2).reshape(blocks_y * block, blocks_x * block, *texel_shape)
+    return np.ascontiguousarray(linear[:height, :width])
+
+
+def _tile_texels(linear: np.ndarray, tiled: np.ndarray):
+    blocks_y, blocks_x, block, _, *texel_shape = tiled.shape
+    padded = np.zeros((blocks_y * block, blocks_x * block, *texel_shape), tiled.dtype)
+    padded[:linear.shape[0], :linear.shape[1]] = linear
+    tiled[...] = padded.reshape(blocks_y, block, blocks_x, block, *texel_shape).swapaxes(1, 2)
 
 
 def mapped(b: typing.Union[cla.Array, Buffer, Image]):
+    tiled_texture_size = getattr(b, '_tiled_texture_size', None)
+
     class _ctx:
         def __init__(self):
             self.mapped = None
+            self.linear = None
         def __enter__(self):
+            with trace_span('map', 'sync'):
+                return self._map()
+        def _map(self):
             if isinstance(b, cl.Image):
                 dtype = __CHANNEL_TYPE_TO_DTYPE__[b.format.channel_data_type]
                 cmps = __CHANNEL_ORDER_TO_COMPONENTS__[b.format.channel_order]
@@ -403,16 +1272,27 @@ def mapped(b: typing.Union[cla.Array, Buffer, Image]):
                     shape = shape[1:]
                 if cmps == 1:
                     shape = shape[:-1]
-                self.mapped = cl.enqueue_map_image(__queue__, b, cl.map_flags.READ | cl.map_flags.WRITE,
+                self.mapped = cl.enqueue_map_image(get_queue(), b, cl.map_flags.READ | cl.map_flags.WRITE,
                                                     (0,0,0), (b.width, max(1, b.height), max(1, b.depth)), shape=shape, dtype=dtype)
             elif isinstance(b, cl.Buffer):
-                self.mapped = cl.enqueue_map_buffer(__queue__, b, cl.map_flags.READ | cl.map_flags.WRITE,
+                self.mapped = cl.enqueue_map_buffer(get_queue(), b, cl.map_flags.READ | cl.map_flags.WRITE,
                                                     b.offset, (b.size,), np.uint8)
             else:
-                self.mapped = cl.enqueue_map_buffer(__queue__, b.base_data, cl.map_flags.READ | cl.map_flags.WRITE,
+                self.mapped = cl.enqueue_map_buffer(get_queue(), b.base_data, cl.map_flags.READ | cl.map_flags.WRITE,
                                                     b.offset, b.shape, b.dtype)
+            if tiled_texture_size is not None:
+                # texels are exposed in linear layout and stored tiled back when unmapped
+                self.linear = _untile_texels(self.mapped[0], *tiled_texture_size)
+                return self.linear
             return self.mapped[0]
         def __exit__(self, exc_type, exc_val, exc_tb):
+            with trace_span('unmap', 'sync'):
+                self._unmap()
+        def _unmap(self):
+            if self.linear is not None:
+                _tile_texels(self.linear, self.mapped[0])
+            if isinstance(b, cla.Array) and b.size == 1:
+                _set_host_mirror(b, self.mapped[0])  # struct values written from host
             self.mapped[0].base.release()
 
     return _ctx()
@@ -549,30 +1429,183 @@ def perspective(fov = 3.141593 / 4, aspect_ratio = 1.0, znear = .01, zfar = 100.
 
 
 class MemoryPool:
-    def __init__(self): # 1GB by default
-        self.max_size = __MAX_SIZE__
-        self.buffer = __MEMORY_POOL_BUFFER__
-        self.malloc_ptr = 0
-
-    def allocate_texture(self, width, height):
-        memory_to_allocate = width * height * 4 * 4
-        if self.malloc_ptr + memory_to_allocate >= self.max_size:
+    """
+    Sub-allocator over a single device buffer hosting textures and generic buffers.
+    Requests are rounded up to size classes, freed blocks are coalesced with free neighbours and reused (best fit).
+    """
+    __MIN_BLOCK_SIZE__ = 256
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.buffer = create_buffer(max_size, np.uint8)
+        self.buffer_ptr = get_buffer_ptr(self.buffer)
+        # sub-buffers origins must be aligned to the device base address alignment (given in bits)
+        self.alignment = max(MemoryPool.__MIN_BLOCK_SIZE__, get_context().devices[0].mem_base_addr_align // 8)
+        self.free_offsets = [0]  # sorted offsets of free blocks
+        self.free_sizes = { 0: max_size }
+        self.allocations = { }  # offset -> (block size, requested size)
+        self.allocated_bytes = 0
+        self.requested_bytes = 0
+        self.peak_allocated_bytes = 0
+
+    def _size_class(self, size: int):
+        # classes have at most 1/8 of internal waste: 8 classes between consecutive powers of two
+        granularity = max(self.alignment, 1 << max(0, size.bit_length() - 4))
+        return (max(size, 1) + granularity - 1) // granularity * granularity
+
+    def allocate(self, size: int) -> int:
+        block_size = self._size_class(size)
+        best = None
+        for offset in self.free_offsets:
+            free_size = self.free_sizes[offset]
+            if free_size >= block_size and (best is None or free_size < self.free_sizes[best]):
+                best = offset
+                if free_size == block_size:
+                    break
+        if best is None:
             raise Exception("Memory out!")
-        memory = self.buffer[self.malloc_ptr:self.malloc_ptr + memory_to_allocate]
+        free_size = self.free_sizes.pop(best)
+        index = bisect.bisect_left(self.free_offsets, best)
+        if free_size > block_size:
+            self.free_offsets[index] = best + block_size
+            self.free_sizes[best + block_size] = free_size - block_size
+        else:
+            del self.free_offsets[index]
+        self.allocations[best] = (block_size, size)
+        self.allocated_bytes += block_size
+        self.requested_bytes += size
+        self.peak_allocated_bytes = max(self.peak_allocated_bytes, self.allocated_bytes)
+        return best
+
+    def free(self, offset: int):
+        assert offset in self.allocations, "Memory was not allocated in this pool or was already released"
+        block_size, size = self.allocations.pop(offset)
+        self.allocated_bytes -= block_size
+        self.requested_bytes -= size
+        index = bisect.bisect_left(self.free_offsets, offset)
+        # coalesce with next free block
+        if index < len(self.free_offsets) and self.free_offsets[index] == offset + block_size:
+            block_size += self.free_sizes.pop(self.free_offsets[index])
+            del self.free_offsets[index]
+        # coalesce with previous free block
+        if index > 0:
+            previous = self.free_offsets[index - 1]
+            if previous + self.free_sizes[previous] == offset:
+                self.free_sizes[previous] += block_size
+                return
+        self.free_offsets.insert(index, offset)
+        self.free_sizes[offset] = block_size
+
+    def allocate_buffer(self, count: int, dtype: np.dtype) -> cla.Array:
+        dtype = np.dtype(dtype)
+        offset = self.allocate(count * dtype.itemsize)
+        memory = self.buffer.base_data.get_sub_region(offset, count * dtype.itemsize)
+        array = cla.Array(get_queue(), (count,), dtype, data=memory)
+        array._pool_offset = offset
+        return array
+
+    def release(self, memory: cla.Array):
+        self.free(memory._pool_offset)
+
+    def allocate_texture(self, width, height, format: TextureFormat = TextureFormat.FLOAT4, mipmaps: bool = False,
+                         layout: TextureLayout = TextureLayout.LINEAR):
+        dtype, components = __TEXEL_FORMATS__[format]
+        texel_size = np.dtype(dtype).itemsize * components
+        block = 1 << layout
+        levels = min(__MAX_TEXTURE_LEVELS__, max(width, height).bit_length()) if mipmaps else 1
+        level_offsets = np.zeros(__MAX_TEXTURE_LEVELS__, np.int32)
+        size = 0
+        for level in range(levels):
+            level_offsets[level] = size
+            # tiled levels are padded to complete blocks
+            level_width = (max(1, width >> level) + block - 1) // block * block
+            level_height = (max(1, height >> level) + block - 1) // block * block
+            size += level_width * level_height * texel_size
+            size = (size + 15) // 16 * 16  # keep every level aligned to a float4
+        memory = self.allocate_buffer(size, np.uint8)
         texture_descriptor = create_struct(Texture2D)
         with mapped(texture_descriptor) as map:
             map['width'] = width
             map['height'] = height
-            map['offset'] = self.malloc_ptr
-        self.malloc_ptr += memory_to_allocate
-        return memory.view(float4).reshape(height, width), texture_descriptor
+            map['offset'] = memory._pool_offset
+            map['format'] = format
+            map['levels'] = levels
+            map['layout'] = layout
+            map['level_offsets'] = level_offsets
+            map['memory'] = self.buffer_ptr
+        offset = memory._pool_offset
+        texel_shape = () if components == 1 else (components,)
+        if layout == TextureLayout.LINEAR:
+            memory = memory[:width * height * texel_size].view(dtype)  # first level only
+            memory = memory.reshape(height, width, *texel_shape)
+        else:
+            blocks_y, blocks_x = (height + block - 1) // block, (width + block - 1) // block
+            memory = memory[:blocks_y * blocks_x * block * block * texel_size].view(dtype)
+            memory = memory.reshape(blocks_y, blocks_x, block, block, *texel_shape)
+            memory._tiled_texture_size = (height, width)  # mapped exposes texels in linear layout
+        memory._pool_offset = offset
+        return memory, texture_descriptor
 
     def get_buffer(self):
         return self.buffer
 
-
-__MEMORY_POOL__ = MemoryPool()
-
-
-def create_texture2D(width: int, height: int):
-    return __MEMORY_POOL__.allocate_texture(width, height)
\ No newline at end of file
+    def get_statistics(self) -> typing.Dict[str, float]:
+        free_bytes = self.max_size - self.allocated_bytes
+        largest_free_block = max(self.free_sizes.values(), default=0)
+        return {
+            'capacity': self.max_size,
+            'allocated_bytes': self.allocated_bytes,
+            'requested_bytes': self.requested_bytes,  # allocated minus size classes rounding
+            'peak_allocated_bytes': self.peak_allocated_bytes,
+            'free_bytes': free_bytes,
+            'largest_free_block': largest_free_block,
+            'free_blocks': len(self.free_offsets),
+            'allocations': len(self.allocations),
+            # 0 when all free memory is contiguous, close to 1 when it is scattered in small blocks
+            'fragmentation': 0.0 if free_bytes == 0 else 1.0 - largest_free_block / free_bytes,
+        }
+
+
+def get_memory_pool() -> MemoryPool:
+    global __MEMORY_POOL__
+    if __MEMORY_POOL__ is None:
+        __MEMORY_POOL__ = MemoryPool(__MAX_SIZE__)  # 1GB by default, see configure_device
+    return __MEMORY_POOL__
+
+
+def create_texture2D(width: int, height: int, format: TextureFormat = TextureFormat.FLOAT4, mipmaps: bool = False,
+                     layout: TextureLayout = TextureLayout.LINEAR):
+    """
+    Allocates a texture in the memory pool. Returns the texture memory and the descriptor to sample it from shaders.
+    The memory is an array of shape (height, width) of float4 for FLOAT4 and float32 for R32F,
+    and (height, width, components) of uint8 for RGBA8 and float16 for HALF4 and RG16F.
+    If mipmaps is set, space for the full mip chain is reserved after the first level.
+    Call generate_mipmaps once the texels are updated.
+    Tiled layouts store texels in square blocks to improve locality of sampling in any direction. Mapping the memory
+    of a tiled texture still exposes the texels in rows and columns.
+    """
+    return get_memory_pool().allocate_texture(width, height, format, mipmaps, layout)
+
+
+def generate_mipmaps(texture_descriptor: cla.Array):
+    """
+    Builds on device every mip level of a texture from its first level.
+    """
+    texture = _get_host_mirror(texture_descriptor)
+    for level in range(1, int(texture['levels'])):
+        threads = max(1, int(texture['width']) >> level) * max(1, int(texture['height']) >> level)
+        __GENERATE_MIP_LEVEL__[threads](texture_descriptor, level)
+
+
+def create_pool_buffer(count: int, dtype: np.dtype):
+    """
+    Creates a buffer allocated inside the memory pool. It can be released with release_pool_memory.
+    """
+    return get_memory_pool().allocate_buffer(count, dtype)
+
+
+def release_pool_memory(memory: cla.Array):
+    """
+    Returns to the pool the memory of a texture or a buffer allocated in the pool.
+    """
+    get_memory_pool().release(memory)
\ No newline at end of file
@@ -1,7 +1,11 @@
 from pywavefront import Wavefront
-from ._core import create_buffer, mapped
+from ._core import create_buffer, mapped, create_texture2D, generate_mipmaps, get_cache_dir, TextureFormat, TextureLayout
 from ._modeling import Mesh, MeshVertex
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import numpy as np
+import os
+import typing
 
 
 def load_obj(path):
@@ -40,3 +44,72 @@ def load_obj(path):
         objs.append((Mesh(mesh_vertices, mesh_indices), None))  # mesh + material
 
     return objs
+
+
+def _decode_texels(path, format: TextureFormat):
+    from PIL import Image
+    with Image.open(path) as image:
+        texels = np.asarray(image.convert('L' if format == TextureFormat.R32F else 'RGBA'))
+    if format == TextureFormat.RGBA8:
+        return texels
+    texels = texels.astype(np.float32) / 255.0
+    if format == TextureFormat.HALF4:
+        texels = texels.astype(np.float16)
+    elif format == TextureFormat.RG16F:
+        texels = texels[..., 0:2].astype(np.float16)
+    return np.ascontiguousarray(texels)
+
+
+def _load_texels(path, format: TextureFormat, use_cache: bool):
+    if not use_cache:
+        return _decode_texels(path, format)
+    with open(path, 'rb') as f:
+        file_hash = hashlib.sha256(f.read()).hexdigest()
+    cache_path = os.path.join(get_cache_dir('textures'), f'{file_hash}_{format.name}.npy')
+    if os.path.exists(cache_path):
+        try:
+            return np.load(cache_path, mmap_mode='r')  # texels are read lazily when uploaded
+        except (OSError, ValueError):
+            pass  # corrupted file, decode again
+    texels = _decode_texels(path, format)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            np.save(f, texels)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass
+    return texels
+
+
+def _upload_texture(texels: np.ndarray, format: TextureFormat, mipmaps: bool, layout: TextureLayout):
+    height, width = texels.shape[0:2]
+    texture_memory, texture_descriptor = create_texture2D(width, height, format, mipmaps, layout)
+    with mapped(texture_memory) as map:
+        if format == TextureFormat.FLOAT4:
+            map = map.view(np.float32).reshape(height, width, 4)
+        map[...] = texels
+    if mipmaps:
+        generate_mipmaps(texture_descriptor)
+    return texture_memory, texture_descriptor
+
+
+def load_texture(path, format: TextureFormat = TextureFormat.RGBA8, mipmaps: bool = False,
+                 layout: TextureLayout = TextureLayout.LINEAR, use_cache: bool = True):
+    """
+    Creates a texture in the memory pool from an image file. Returns the texture memory and descriptor as
+    create_texture2D. Converted texels are cached on disk (keyed by the file content and the format),
+    so next loads of the same image skip the decoding.
+    """
+    return _upload_texture(_load_texels(path, format, use_cache), format, mipmaps, layout)
+
+
+def load_textures(paths: typing.List[str], format: TextureFormat = TextureFormat.RGBA8, mipmaps: bool = False,
+                  layout: TextureLayout = TextureLayout.LINEAR, use_cache: bool = True):
+    """
+    Same as load_texture for several images. Images are decoded in parallel.
+    """
+    with ThreadPoolExecutor() as executor:
+        all_texels = list(executor.map(lambda path: _load_texels(path, format, use_cache), paths))
+    return [_upload_texture(texels, format, mipmaps, layout) for texels in all_texels]
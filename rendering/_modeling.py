@@ -1,7 +1,7 @@
 import pyopencl as cl
 import pyopencl.array as cla
 from enum import IntEnum
-from ._core import kernel_struct, float3, float2, __queue__, create_buffer, mapped
+from ._core import kernel_struct, float3, float2, create_buffer, mapped
 import numpy as np
 
 
@@ -1,13 +1,20 @@
-from ._core import create_image2d, RGBA, mapped
+from ._core import create_image2d, RGBA, mapped, is_profiling, get_profiler, trace_span
 import numpy as np
 import time
 import os
 __CURRENT_PATH__ = os.path.dirname(__file__)
 os.environ["PYSDL2_DLL_PATH"] = __CURRENT_PATH__ + "/third-party/SDL2"
-import sdl2
-import sdl2.ext
 import ctypes
 from enum import Enum
+sdl2 = None  # imported with the first window, offline use (e.g. benchmarks) does not require SDL
+
+
+def _import_sdl2():
+    global sdl2
+    if sdl2 is None:
+        import sdl2
+        import sdl2.ext
+    return sdl2
 
 
 class Event(Enum):
@@ -22,6 +29,7 @@ class Presenter:
         self.offline = offline
         self.window = None
         if not offline:
+            _import_sdl2()
             if sdl2.SDL_Init(sdl2.SDL_INIT_VIDEO) != 0:
                 raise Exception(sdl2.SDL_GetError())
             self.window = sdl2.SDL_CreateWindow(
@@ -61,6 +69,8 @@ class Presenter:
             buffer[:] = map.ravel()
 
     def present(self):
+        if is_profiling():
+            get_profiler().end_frame()
         if self.offline:
             return
 
@@ -75,7 +85,8 @@ class Presenter:
         )
         full_image = ctypes.c_char*self.width*self.height*4
         buffer = np.frombuffer(full_image.from_address(pixel_ptr.value), dtype=np.uint8)
-        self._copy_render_target(buffer)
+        with trace_span('present_copy', 'present'):
+            self._copy_render_target(buffer)
         sdl2.SDL_UnlockTexture(self.sdl_texture)
         sdl2.SDL_RenderCopy(self.sdl_renderer, self.sdl_texture, None, None)
         sdl2.SDL_RenderPresent(self.sdl_renderer)
@@ -90,3 +101,10 @@ class Presenter:
 def create_presenter(width: int, height: int) -> Presenter:
     return Presenter(width, height, False)
 
+
+def create_offline_presenter(width: int, height: int) -> Presenter:
+    """
+    Presenter without window, the render target is created but present only ends the frame.
+    """
+    return Presenter(width, height, True)
+
@@ -1,6 +1,9 @@
 from enum import IntEnum
-from ._core import build_kernel_main, build_kernel_function, float2, float4, __ctx__, w_image2d_t, create_buffer, make_float2, int2, make_int2, MemoryPool
+from ._core import build_kernel_main, build_kernel_function, float2, float4, w_image2d_t, create_buffer, make_float2, int2, int4, make_int2, clear, read_buffer_async, write_buffer_async, _get_host_mirror, get_queue, has_device_extension, MemoryPool, traced, trace_span
 import inspect
+import typing
+import pyopencl as cl
+import pyopencl.array as cla
 import pyopencl.tools as cltools
 import numpy as np
 
@@ -12,14 +15,38 @@ class FillMode(IntEnum):
     SOLID = 3
 
 
+class ShadingMode(IntEnum):
+    FORWARD = 0  # fragments are shaded while rastering
+    VISIBILITY = 1  # rasters write the closest primitive of every pixel and a screen pass shades them
+
+
+class CullMode(IntEnum):
+    NONE = 0
+    BACK = 1  # culls triangles clockwise in screen, front faces of models are counterclockwise (e.g. dragon.obj)
+    FRONT = 2  # culls triangles counterclockwise in screen
+
+
 __VERTEX_PROCESS_CACHE__ = { }
 __FRAGMENT_PROCESS_CACHE__ = { }
 __PRIMITIVE_ASSEMBLY_CACHE__ = { }
 __HOMOGENIZATION_CACHE__ = { }
 __RASTER_CACHE__ = { }
 __TILING_CACHE__ = { }
+__TILE_RASTER_CACHE__ = { }
+__SMALL_TRIANGLE_CACHE__ = { }
+__SMALL_TRIANGLE_RASTER_CACHE__ = { }
+__VISIBILITY_CACHE__ = { }
+__VISIBILITY_RESOLVE_CACHE__ = { }
+__POINT_VISIBILITY_RESOLVE_CACHE__ = { }
 __INTERPOLATORS_2__ = { }
 __INTERPOLATORS_3__ = { }
+__PIPELINE_STATISTICS__ = ('input_primitives', 'clipped_primitives', 'split_primitives', 'assembled_primitives',
+                           'binned_tiles', 'large_primitives', 'small_primitives', 'fragments', 'depth_passed', 'shaded_fragments')
+
+
+def _count_statistic(name: str, amount: str = '1'):
+    # kernels count pipeline statistics only when a statistics buffer is bound
+    return f'if (statistics != 0) atomic_add(statistics + {__PIPELINE_STATISTICS__.index(name)}, {amount});'
 
 
 def _resolve_interpolators_2(vertex_type):
@@ -60,17 +87,40 @@ def _resolve_interpolators_3(vertex_type):
 
 
 
-def _resolve_vertex_kernel(input_type, globals_type, output_type, shader):
-    if shader.name not in __VERTEX_PROCESS_CACHE__:
-        k = build_kernel_main(
-            name=f'VertexProcess_{shader.name}',
-            arguments={ 'in_vertices': [input_type], 'globals': globals_type, 'out_vertices': [output_type] },
-            body=f"""
-    out_vertices[thread_id] = {shader.name}(in_vertices[thread_id], globals);
-            """
-        )
-        __VERTEX_PROCESS_CACHE__[shader.name] = k
-    return __VERTEX_PROCESS_CACHE__[shader.name]
+def _resolve_vertex_kernel(input_type, globals_type, output_type, shader, instance_type = None, per_draw: bool = False):
+    if (shader.name, per_draw) not in __VERTEX_PROCESS_CACHE__:
+        if per_draw:
+            # draw lists read the globals of the draw from an array
+            k = build_kernel_main(
+                name=f'VertexProcessList_{shader.name}',
+                arguments={ 'in_vertices': [input_type], 'globals': [globals_type], 'draw': np.int32, 'out_vertices': [output_type], 'first_vertex': np.int32 },
+                body=f"""
+    out_vertices[thread_id] = {shader.name}(in_vertices[first_vertex + thread_id], globals[draw]);
+                """
+            )
+        elif instance_type is None:
+            k = build_kernel_main(
+                name=f'VertexProcess_{shader.name}',
+                arguments={ 'in_vertices': [input_type], 'globals': globals_type, 'out_vertices': [output_type], 'first_vertex': np.int32 },
+                body=f"""
+    out_vertices[thread_id] = {shader.name}(in_vertices[first_vertex + thread_id], globals);
+                """
+            )
+        else:
+            # vertices of all instances are processed as a single stream, one copy of the mesh after the other
+            instance_id_arg = ', instance' if len(shader.signature) == 4 else ''
+            k = build_kernel_main(
+                name=f'VertexProcess_{shader.name}',
+                arguments={ 'in_vertices': [input_type], 'globals': globals_type, 'out_vertices': [output_type], 'first_vertex': np.int32,
+                            'instances': [instance_type], 'vertices_per_instance': np.int32 },
+                body=f"""
+    int vertex = first_vertex + thread_id;
+    int instance = vertex / vertices_per_instance;
+    out_vertices[thread_id] = {shader.name}(in_vertices[vertex % vertices_per_instance], globals, instances[instance]{instance_id_arg});
+                """
+            )
+        __VERTEX_PROCESS_CACHE__[(shader.name, per_draw)] = k
+    return __VERTEX_PROCESS_CACHE__[(shader.name, per_draw)]
 
 
 def _resolve_fragment_kernel(input_type : np.dtype, globals_type, shader):
@@ -79,35 +129,46 @@ def _resolve_fragment_kernel(input_type : np.dtype, globals_type, shader):
 
         depth_test = build_kernel_main(
             name=f'DepthTest_{shader.name}',
-            arguments={ 'in_fragments': [input_type], 'globals': globals_type, 'render_target': w_image2d_t, 'depth_buffer': [np.uint32] },
+            arguments={ 'in_fragments': [input_type], 'globals': globals_type, 'render_target': w_image2d_t, 'depth_buffer': [np.uint32],
+                        'statistics': [np.uint32], 'overdraw': [np.uint32] },
             body=f"""
     float4 proj = in_fragments[thread_id].{projection_field};
     if (proj.z < 0)
         return;
     int2 dim = get_image_dim(render_target);
+    if (proj.x < 0 || proj.x >= dim.x || proj.y < 0 || proj.y >= dim.y) // clipping
+        return;
     int px = (int)proj.x;
     int py = (int)proj.y;
     uint depth = as_uint(proj.z);
     atomic_min(depth_buffer+(py * dim.x + px), depth);
+    {_count_statistic('fragments')}
+    if (overdraw != 0)
+        atomic_inc(overdraw + (py * dim.x + px));
             """
         )
 
         k = build_kernel_main(
             name=f'FragmentProcess_{shader.name}',
             arguments={'in_fragments': [input_type], 'globals': globals_type, 'render_target': w_image2d_t,
-                       'depth_buffer': [np.uint32]},
+                       'depth_buffer': [np.uint32], 'statistics': [np.uint32]},
             body=f"""
-        float4 color = {shader.name}(in_fragments[thread_id], globals);
         float4 proj = in_fragments[thread_id].{projection_field};
         if (proj.z <= 0)
             return;
         int2 dim = get_image_dim(render_target);
+        if (proj.x < 0 || proj.x >= dim.x || proj.y < 0 || proj.y >= dim.y) // clipping
+            return;
         int px = (int)proj.x;
         int py = (int)proj.y;
         uint depth = as_uint(proj.z);
         uint written_depth = *(depth_buffer + py * dim.x + px);
-        if (written_depth == depth) // minimum 
-            write_imagef(render_target, (int2)(px, py), color);
+        if (written_depth != depth) // only the minimum is shaded
+            return;
+        {_count_statistic('depth_passed')}
+        {_count_statistic('shaded_fragments')}
+        float4 color = {shader.name}(in_fragments[thread_id], globals);
+        write_imagef(render_target, (int2)(px, py), color);
                 """
         )
 
@@ -121,12 +182,15 @@ def _resolve_homogenize_and_viewport(vertex_type: np.dtype):
         projection_field = [k for k, (d, offset) in vertex_type.fields.items() if offset == 0][0]
         k = build_kernel_main(
             name=f'Dehomogenize_{cl_vertex_name}',
-            arguments={'vertex_buffer': [vertex_type], 'viewport_dim': float2 },
+            arguments={'vertex_buffer': [vertex_type], 'viewport_dim': float2, 'vertices_per_primitive': np.int32 },
             body=f"""
-            vertex_buffer[thread_id].{projection_field}.xyz /= vertex_buffer[thread_id].{projection_field}.w;
-            vertex_buffer[thread_id].{projection_field}.y *= -1.0f;
-            vertex_buffer[thread_id].{projection_field}.xy += (float2)(1, 1);
-            vertex_buffer[thread_id].{projection_field}.xy *= viewport_dim * 0.5f;
+            for (int index = thread_id * vertices_per_primitive; index < (thread_id + 1) * vertices_per_primitive; index++)
+            {{
+                vertex_buffer[index].{projection_field}.xyz /= vertex_buffer[index].{projection_field}.w;
+                vertex_buffer[index].{projection_field}.y *= -1.0f;
+                vertex_buffer[index].{projection_field}.xy += (float2)(1, 1);
+                vertex_buffer[index].{projection_field}.xy *= viewport_dim * 0.5f;
+            }}
                     """
         )
         __HOMOGENIZATION_CACHE__[vertex_type] = k
@@ -139,38 +203,82 @@ def _resolve_primitive_assembly_and_clipping_z0(vertex_type: np.dtype):
         projection_field = [k for k, (d, offset) in vertex_type.fields.items() if offset == 0][0]
         point_kernel = build_kernel_main(
             name=f'PointAssembly_{cl_vertex_name}',
-            arguments={'vertex_buffer': [vertex_type], 'index_buffer': [np.int32], 'count': [np.int32], 'primitive_buffer': [vertex_type]},
+            arguments={'vertex_buffer': [vertex_type], 'index_buffer': [np.int32], 'count': [np.int32], 'primitive_buffer': [vertex_type],
+                       'first_primitive': np.int32, 'primitives_per_instance': np.int32, 'vertices_per_instance': np.int32,
+                       'statistics': [np.uint32]},
             body=f"""
-            int index = index_buffer == 0 ? thread_id : index_buffer[thread_id];
+            {_count_statistic('input_primitives')}
+            int primitive = first_primitive + thread_id;
+            int index = index_buffer == 0 ? thread_id :
+                index_buffer[primitive % primitives_per_instance] + (primitive / primitives_per_instance) * vertices_per_instance;
             float4 proj = vertex_buffer[index].{projection_field};
             if (proj.z < 0) // clipping_z0
                 return;
             int out_index = atomic_add(count, 1);
             primitive_buffer[out_index] = vertex_buffer[index];
+            {_count_statistic('assembled_primitives')}
                     """
         )
         triangle_kernel = build_kernel_main(
             name=f'TriangleAssembly_{cl_vertex_name}',
-            arguments={'vertex_buffer': [vertex_type], 'index_buffer': [np.int32], 'count': [np.int32], 'primitive_buffer': [vertex_type]},
+            arguments={'vertex_buffer': [vertex_type], 'index_buffer': [np.int32], 'count': [np.int32], 'primitive_buffer': [vertex_type],
+                       'first_primitive': np.int32, 'primitives_per_instance': np.int32, 'vertices_per_instance': np.int32,
+                       'cull_mode': np.int32, 'culled': [np.int32], 'draw': np.int32, 'primitive_draws': [np.int32],
+                       'statistics': [np.uint32]},
             body=f"""
-            int index0 = index_buffer == 0 ? thread_id*3+0 : index_buffer[thread_id*3+0];
-            int index1 = index_buffer == 0 ? thread_id*3+1 : index_buffer[thread_id*3+1];
-            int index2 = index_buffer == 0 ? thread_id*3+2 : index_buffer[thread_id*3+2];
+            {_count_statistic('input_primitives')}
+            // vertex_buffer holds the vertices of the batch when not indexed, or all mesh vertices of the instances
+            // in the batch otherwise (indices are offset for every instance)
+            int primitive = (first_primitive + thread_id) % primitives_per_instance;
+            int instance_offset = ((first_primitive + thread_id) / primitives_per_instance) * vertices_per_instance;
+            int index0 = index_buffer == 0 ? thread_id*3+0 : index_buffer[primitive*3+0] + instance_offset;
+            int index1 = index_buffer == 0 ? thread_id*3+1 : index_buffer[primitive*3+1] + instance_offset;
+            int index2 = index_buffer == 0 ? thread_id*3+2 : index_buffer[primitive*3+2] + instance_offset;
             float4 proj0 = vertex_buffer[index0].{projection_field};
             float4 proj1 = vertex_buffer[index1].{projection_field};
             float4 proj2 = vertex_buffer[index2].{projection_field};
+
+            // frustum culling, the triangle is rejected if all vertices are outside the same plane
+            if ((proj0.x < -proj0.w && proj1.x < -proj1.w && proj2.x < -proj2.w) ||
+                (proj0.x > proj0.w && proj1.x > proj1.w && proj2.x > proj2.w) ||
+                (proj0.y < -proj0.w && proj1.y < -proj1.w && proj2.y < -proj2.w) ||
+                (proj0.y > proj0.w && proj1.y > proj1.w && proj2.y > proj2.w) ||
+                (proj0.z > proj0.w && proj1.z > proj1.w && proj2.z > proj2.w))
+            {{
+                atomic_inc(culled + 0);
+                return;
+            }}
+
+            // face culling, the sign of the determinant of homogeneous positions (x, y, w) is the orientation
+            // in screen, valid even for triangles crossing the z=0 plane
+            float orientation = proj0.x * (proj1.y * proj2.w - proj2.y * proj1.w)
+                              - proj1.x * (proj0.y * proj2.w - proj2.y * proj0.w)
+                              + proj2.x * (proj0.y * proj1.w - proj1.y * proj0.w);
+            if ((cull_mode == {int(CullMode.BACK)} && orientation > 0) || (cull_mode == {int(CullMode.FRONT)} && orientation < 0))
+            {{
+                atomic_inc(culled + 1);
+                return;
+            }}
             
             int clip_mode = (proj0.z < 0 ? 1 : 0) | (proj1.z < 0 ? 2 : 0) | (proj2.z < 0 ? 4 : 0);  
             
-            if (clip_mode == 7) return; // the hole triangle is back
+            if (clip_mode == 7) // the hole triangle is back
+            {{
+                atomic_inc(culled + 0);
+                return;
+            }}
+            if (clip_mode != 0)
+                {_count_statistic('clipped_primitives')}
 
             {cl_vertex_name} v0 = vertex_buffer[index0];
             {cl_vertex_name} v1 = vertex_buffer[index1];
             {cl_vertex_name} v2 = vertex_buffer[index2];
             
-            {cl_vertex_name} v01 = interpolate2_{cl_vertex_name}(v0, v1, -proj0.z / (proj1.z - proj0.z));
-            {cl_vertex_name} v12 = interpolate2_{cl_vertex_name}(v1, v2, -proj1.z / (proj2.z - proj1.z));
-            {cl_vertex_name} v20 = interpolate2_{cl_vertex_name}(v2, v0, -proj2.z / (proj0.z - proj2.z));
+            // intersections with z=0 are interpolated from the vertex in front, so triangles sharing a clipped edge
+            // get exactly the same vertex
+            {cl_vertex_name} v01 = proj0.z < 0 ? interpolate2_{cl_vertex_name}(v1, v0, -proj1.z / (proj0.z - proj1.z)) : interpolate2_{cl_vertex_name}(v0, v1, -proj0.z / (proj1.z - proj0.z));
+            {cl_vertex_name} v12 = proj1.z < 0 ? interpolate2_{cl_vertex_name}(v2, v1, -proj2.z / (proj1.z - proj2.z)) : interpolate2_{cl_vertex_name}(v1, v2, -proj1.z / (proj2.z - proj1.z));
+            {cl_vertex_name} v20 = proj2.z < 0 ? interpolate2_{cl_vertex_name}(v0, v2, -proj0.z / (proj2.z - proj0.z)) : interpolate2_{cl_vertex_name}(v2, v0, -proj2.z / (proj0.z - proj2.z));
             
             {cl_vertex_name} v_out[3];
             // First triangle
@@ -188,6 +296,9 @@ def _resolve_primitive_assembly_and_clipping_z0(vertex_type: np.dtype):
             primitive_buffer[3*out_index + 0] = v_out[0];
             primitive_buffer[3*out_index + 1] = v_out[1];
             primitive_buffer[3*out_index + 2] = v_out[2];
+            if (primitive_draws != 0) // draw lists keep the draw of every primitive
+                primitive_draws[out_index] = draw;
+            {_count_statistic('assembled_primitives')}
 
             // Second triangle
             switch (clip_mode){{
@@ -197,10 +308,14 @@ def _resolve_primitive_assembly_and_clipping_z0(vertex_type: np.dtype):
                 default:
                 return; // no second triangle needed
             }}
+            {_count_statistic('split_primitives')}
             out_index = atomic_add(count, 1);
             primitive_buffer[3*out_index + 0] = v_out[0];
             primitive_buffer[3*out_index + 1] = v_out[1];
             primitive_buffer[3*out_index + 2] = v_out[2];
+            if (primitive_draws != 0)
+                primitive_draws[out_index] = draw;
+            {_count_statistic('assembled_primitives')}
                     """
         )
         __PRIMITIVE_ASSEMBLY_CACHE__[vertex_type] = (point_kernel, None, triangle_kernel)
@@ -224,149 +339,826 @@ def _resolve_raster_kernels(vertex_type: np.dtype):
                     fragment_buffer[out_index] = primitive_buffer[index];
                             """
         )
-        triangle_raster_kernel = build_kernel_main(
-            name=f'TriangleRaster_{cl_vertex_name}',
-            arguments={'primitive_buffer': [vertex_type], 'primitive_drawn': [np.int32], 'counting': [np.int32], 'fragment_count': [np.int32],
-                       'fragment_buffer': [vertex_type], 'fragment_buffer_capacity': np.int32, 'viewport_dim': int2},
+        __RASTER_CACHE__[vertex_type] = point_raster_kernel, None, None  # Point, Line, Triangle rasters (triangles are tiled)
+    return __RASTER_CACHE__[vertex_type]
+
+
+__TILE_SIZE__ = 16  # tiles of 16x16 pixels, each one rasterized by a work-group of 256 threads
+__TILE_PIXELS__ = __TILE_SIZE__ * __TILE_SIZE__
+__LARGE_TRIANGLE_TILES__ = 16  # triangles overlapping more tiles are not binned but tested by every tile in their bounds
+__NO_PRIMITIVE__ = -2147483648  # marks an empty slot of a chunk of triangles
+__SMALL_TRIANGLE_PIXELS__ = 128  # triangles inside a tile with smaller pixel bounds are rastered by a thread each (measured)
+
+
+build_kernel_function(
+    name='triangle_pixel_bounds',
+    arguments={'p0': float4, 'p1': float4, 'p2': float4, 'viewport_dim': int2},
+    return_type=int4,
+    body="""
+    // range of pixels (x0, y0, x1, y1) overlapped by the bounding box of a triangle, empty if x1 < x0 or y1 < y0
+    float2 e1 = p1.xy - p0.xy;
+    float2 e2 = p2.xy - p0.xy;
+    if (e1.x * e2.y - e1.y * e2.x == 0)
+        return (int4)(0, 0, -1, -1); // degenerated triangle, covers no pixel
+    // bounds are clamped before conversion, vertices close to the z=0 plane can be projected very far
+    int startx = (int)clamp(min(p0.x, min(p1.x, p2.x)), 0.0f, (float)viewport_dim.x);
+    int starty = (int)clamp(min(p0.y, min(p1.y, p2.y)), 0.0f, (float)viewport_dim.y);
+    int endx = min(viewport_dim.x - 1, 1 + (int)clamp(max(p0.x, max(p1.x, p2.x)), -1.0f, (float)viewport_dim.x));
+    int endy = min(viewport_dim.y - 1, 1 + (int)clamp(max(p0.y, max(p1.y, p2.y)), -1.0f, (float)viewport_dim.y));
+    if (startx > endx || starty > endy)
+        return (int4)(0, 0, -1, -1);
+    return (int4)(startx, starty, endx, endy);
+    """
+)
+
+
+build_kernel_function(
+    name='triangle_tile_bounds',
+    arguments={'p0': float4, 'p1': float4, 'p2': float4, 'viewport_dim': int2},
+    return_type=int4,
+    body=f"""
+    // range of tiles (x0, y0, x1, y1) overlapped by the pixel bounding box of a triangle, empty if x1 < x0 or y1 < y0
+    int4 pixels = triangle_pixel_bounds(p0, p1, p2, viewport_dim);
+    return pixels.z < 0 ? pixels : pixels / {__TILE_SIZE__};
+    """
+)
+
+
+build_kernel_function(
+    name='triangle_is_small',
+    arguments={'p0': float4, 'p1': float4, 'p2': float4, 'viewport_dim': int2, 'small_pixels': np.int32},
+    return_type=np.int32,
+    body=f"""
+    // triangles with pixel bounds inside a single tile and covering up to small_pixels skip binning
+    int4 pixels = triangle_pixel_bounds(p0, p1, p2, viewport_dim);
+    return pixels.z >= 0 && (pixels.z - pixels.x + 1) * (pixels.w - pixels.y + 1) <= small_pixels
+        && pixels.x / {__TILE_SIZE__} == pixels.z / {__TILE_SIZE__} && pixels.y / {__TILE_SIZE__} == pixels.w / {__TILE_SIZE__};
+    """
+)
+
+
+build_kernel_function(
+    name='triangle_min_depth',
+    arguments={'p0': float4, 'p1': float4, 'p2': float4},
+    return_type=np.uint32,
+    body="""
+    // closest depth of a triangle, as uint to be compared with depth buffers
+    return as_uint(max(0.0f, min(p0.z, min(p1.z, p2.z))));
+    """
+)
+
+
+build_kernel_function(
+    name='edge_equation',
+    arguments={'p': float4, 'q': float4},
+    return_type=float4,
+    body="""
+    // edge p->q as (dy, dx, x, y) with (x, y) one of its vertices. Edges are evaluated relative to a vertex to avoid
+    // cancellation far from the origin, and the vertex is chosen by position (not by order) so triangles sharing an
+    // edge get exactly opposite values and leave no cracks between them
+    float2 r = (q.y < p.y || (q.y == p.y && q.x < p.x)) ? q.xy : p.xy;
+    return (float4)(q.y - p.y, q.x - p.x, r.x, r.y);
+    """
+)
+
+
+build_kernel_function(
+    name='edge_function',
+    arguments={'e': float4, 'px': np.float32, 'py': np.float32},
+    return_type=np.float32,
+    body="""
+    return e.x * (px - e.z) - e.y * (py - e.w);
+    """
+)
+
+
+build_kernel_function(
+    name='edge_inside',
+    arguments={'d': np.float32, 'top_left': np.int32},
+    return_type=np.int32,
+    body="""
+    // exact test of the edge function, no tolerance that would grow with the triangle area. Pixel centers on a shared
+    // edge belong only to the triangle where it is a top or left edge
+    return d > 0 || (d == 0 && top_left);
+    """
+)
+
+
+__HIZ_BUILD__ = build_kernel_main(
+    name='HiZBuild',
+    arguments={'depth_buffer': [np.uint32], 'hiz': [np.uint32], 'viewport_dim': int2},
+    group_size=__TILE_PIXELS__,
+    body=f"""
+    // coarse depth buffer with the farthest depth of every tile
+    __local uint tile_max_depth;
+    int tile = thread_id / {__TILE_PIXELS__};
+    int local_id = thread_id % {__TILE_PIXELS__};
+    int tiles_x = (viewport_dim.x + {__TILE_SIZE__ - 1}) / {__TILE_SIZE__};
+    int col = (tile % tiles_x) * {__TILE_SIZE__} + local_id % {__TILE_SIZE__};
+    int row = (tile / tiles_x) * {__TILE_SIZE__} + local_id / {__TILE_SIZE__};
+    if (local_id == 0)
+        tile_max_depth = 0;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    if (col < viewport_dim.x && row < viewport_dim.y)
+        atomic_max(&tile_max_depth, depth_buffer[row * viewport_dim.x + col]);
+    barrier(CLK_LOCAL_MEM_FENCE);
+    if (local_id == 0)
+        hiz[tile] = tile_max_depth;
+    """
+)
+
+
+__TILE_SCAN__ = build_kernel_main(
+    name='TileScan',
+    arguments={'tile_counts': [np.int32], 'tile_offsets': [np.int32], 'number_of_tiles': np.int32},
+    group_size=__TILE_PIXELS__,
+    body=f"""
+    // exclusive prefix sum of tile counts computed by a single work-group.
+    // Every thread scans a segment sequentially, then segment sums are scanned in local memory.
+    __local int segment_offsets[{__TILE_PIXELS__}];
+    int segment_size = (number_of_tiles + {__TILE_PIXELS__ - 1}) / {__TILE_PIXELS__};
+    int start = min(number_of_tiles, thread_id * segment_size);
+    int end = min(number_of_tiles, start + segment_size);
+    int sum = 0;
+    for (int i = start; i < end; i++)
+        sum += tile_counts[i];
+    segment_offsets[thread_id] = sum;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    if (thread_id == 0)
+    {{
+        int total = 0;
+        for (int i = 0; i < {__TILE_PIXELS__}; i++)
+        {{
+            int count = segment_offsets[i];
+            segment_offsets[i] = total;
+            total += count;
+        }}
+        tile_offsets[number_of_tiles] = total;
+    }}
+    barrier(CLK_LOCAL_MEM_FENCE);
+    sum = segment_offsets[thread_id];
+    for (int i = start; i < end; i++)
+    {{
+        tile_offsets[i] = sum;
+        sum += tile_counts[i];
+    }}
+    """
+)
+
+
+def _resolve_tile_binning_kernels(vertex_type: np.dtype):
+    if vertex_type not in __TILING_CACHE__:
+        cl_vertex_name = cltools.dtype_to_ctype(vertex_type)
+        projection_field = [k for k, (d, offset) in vertex_type.fields.items() if offset == 0][0]
+        count_kernel = build_kernel_main(
+            name=f'TileBinCount_{cl_vertex_name}',
+            arguments={'primitive_buffer': [vertex_type], 'tile_counts': [np.int32], 'large_count': [np.int32],
+                       'large_primitives': [np.int32], 'small_count': [np.int32], 'small_primitives': [np.int32],
+                       'small_pixels': np.int32, 'hiz': [np.uint32], 'viewport_dim': int2, 'statistics': [np.uint32]},
+            body=f"""
+            float4 p0 = primitive_buffer[3*thread_id + 0].{projection_field};
+            float4 p1 = primitive_buffer[3*thread_id + 1].{projection_field};
+            float4 p2 = primitive_buffer[3*thread_id + 2].{projection_field};
+            int4 tiles = triangle_tile_bounds(p0, p1, p2, viewport_dim);
+            int tiles_x = (viewport_dim.x + {__TILE_SIZE__ - 1}) / {__TILE_SIZE__};
+            if (triangle_is_small(p0, p1, p2, viewport_dim, small_pixels))
+            {{
+                if (triangle_min_depth(p0, p1, p2) <= hiz[tiles.y * tiles_x + tiles.x]) // otherwise hidden in the tile
+                {{
+                    small_primitives[atomic_inc(small_count)] = thread_id;
+                    {_count_statistic('small_primitives')}
+                }}
+                return;
+            }}
+            if ((tiles.z - tiles.x + 1) * (tiles.w - tiles.y + 1) > {__LARGE_TRIANGLE_TILES__})
+            {{
+                large_primitives[atomic_inc(large_count)] = thread_id;
+                {_count_statistic('large_primitives')}
+                return;
+            }}
+            uint min_depth = triangle_min_depth(p0, p1, p2);
+            for (int ty = tiles.y; ty <= tiles.w; ty++)
+                for (int tx = tiles.x; tx <= tiles.z; tx++)
+                    if (min_depth <= hiz[ty * tiles_x + tx]) // otherwise hidden in the whole tile
+                    {{
+                        atomic_inc(tile_counts + ty * tiles_x + tx);
+                        {_count_statistic('binned_tiles')}
+                    }}
+            """
+        )
+        scatter_kernel = build_kernel_main(
+            name=f'TileBinScatter_{cl_vertex_name}',
+            arguments={'primitive_buffer': [vertex_type], 'tile_offsets': [np.int32], 'tile_fill': [np.int32],
+                       'tile_entries': [np.int32], 'small_pixels': np.int32, 'hiz': [np.uint32], 'viewport_dim': int2},
             body=f"""
-                            int index = thread_id;
-                            float4 proj0 = primitive_buffer[3*index + 0].{projection_field};
-                            float4 proj1 = primitive_buffer[3*index + 1].{projection_field};
-                            float4 proj2 = primitive_buffer[3*index + 2].{projection_field};
-                            if (proj0.z < 0) return; // already rendered
-                            int startx = max(0, (int)min(proj0.x, min(proj1.x, proj2.x)));
-                            int starty = max(0, (int)min(proj0.y, min(proj1.y, proj2.y)));
-                            int endx = min(viewport_dim.x - 1, 1 + (int)max(proj0.x, max(proj1.x, proj2.x)));
-                            int endy = min(viewport_dim.y - 1, 1 + (int)max(proj0.y, max(proj1.y, proj2.y)));
-                            int pixel_count = (endx - startx + 1)*(endy - starty + 1);
-                            
-                            int potential_index = atomic_add(counting, pixel_count);
-
-                            if (potential_index + pixel_count < fragment_buffer_capacity)
-                            {{
-                                atomic_add(primitive_drawn, 1);
-                                
-                                {cl_vertex_name} v1 = primitive_buffer[3*index + 0];
-                                {cl_vertex_name} v2 = primitive_buffer[3*index + 1];
-                                {cl_vertex_name} v3 = primitive_buffer[3*index + 2];
-                                
-                                float2 a = v1.{projection_field}.xy;
-                                float2 b = v2.{projection_field}.xy;
-                                float2 c = v3.{projection_field}.xy;
-                                
-                                float2 vec1 = b - a;
-                                float2 vec2 = c - a;
-                                bool is_counter_clockwise = (vec1.x * vec2.y - vec1.y * vec2.x) <= 0;
-                                
-                                if (!is_counter_clockwise) // Grant is Counterclockwised
-                                {{
-                                    {cl_vertex_name} temp = v2;
-                                    v2 = v3;
-                                    v3 = temp;
-                                }}
-                                
-                                float4 h1 = v1.{projection_field};
-                                float4 h2 = v2.{projection_field};
-                                float4 h3 = v3.{projection_field};
-                                
-                                float a1, b1, c1, a2, b2, c2, a3, b3, c3;
-
-                                a1 = (h2.y - h1.y);
-                                b1 = (h1.x - h2.x);
-                                c1 = h1.x * (h1.y - h2.y) - h1.y * (h1.x - h2.x);
-                
-                                a2 = (h3.y - h2.y);
-                                b2 = (h2.x - h3.x);
-                                c2 = h2.x * (h2.y - h3.y) - h2.y * (h2.x - h3.x);
-                
-                                a3 = (h1.y - h3.y);
-                                b3 = (h3.x - h1.x);
-                                c3 = h3.x * (h3.y - h1.y) - h3.y * (h3.x - h1.x);
-                
-                                bool v1v2IsTLE = (h1.y == h2.y && h2.x <= h1.x) || h1.y < h2.y;
-                                bool v2v3IsTLE = (h2.y == h3.y && h3.x <= h2.x) || h2.y < h3.y;
-                                bool v3v1IsTLE = (h3.y == h1.y && h1.x <= h3.x) || h3.y < h1.y;
-                
-                                float comp3 = v1v2IsTLE ? 0 : 0.00000001;
-                                float comp1 = v2v3IsTLE ? 0 : 0.00000001;
-                                float comp2 = v3v1IsTLE ? 0 : 0.00000001;
-
-                                if (pixel_count < 64*64)
-                                for (int row = starty; row <= endy; row++)
-                                    for (int col = startx; col <= endx; col++)
-                                    {{
-                                        float px = col + 0.5f;
-                                        float py = row + 0.5f; // set at the middle of the pixel
-
-                                        float d1 = a1 * px + b1 * py + c1;
-                                        float d2 = a2 * px + b2 * py + c2;
-                                        float d3 = a3 * px + b3 * py + c3;
-
-                                        float alpha3 = d1 / (d1 + d2 + d3);
-                                        float alpha1 = d2 / (d1 + d2 + d3);
-                                        float alpha2 = d3 / (d1 + d2 + d3);
-                                        
-                                        float4 h_int = h1 * alpha1 + h2 * alpha2 + h3 * alpha3;
-
-                                        if (alpha1 >= comp1 && alpha2 >= comp2 && alpha3 >= comp3)
-                                        {{ // interior
-                                            float beta1 = (alpha1 / h1.w) / (alpha1 / h1.w + alpha2 / h2.w + alpha3 / h3.w);
-                                            float beta2 = (alpha2 / h2.w) / (alpha1 / h1.w + alpha2 / h2.w + alpha3 / h3.w);
-                                            float beta3 = (alpha3 / h3.w) / (alpha1 / h1.w + alpha2 / h2.w + alpha3 / h3.w);
-                                            
-                                            {cl_vertex_name} fragment = interpolate3_{cl_vertex_name}(v1, v2, v3, (float2)(beta2, beta3));
-                                            fragment.{projection_field} = h_int;
-                                            int fragment_pos = atomic_add(fragment_count, 1);
-                                            fragment_buffer[fragment_pos] = fragment;
-                                        }}
-                                    }}
-                                // mark primitive as drawn
-                                primitive_buffer[3*index + 0].{projection_field}.z = -1;
-                            }}
-                                    """
+            float4 p0 = primitive_buffer[3*thread_id + 0].{projection_field};
+            float4 p1 = primitive_buffer[3*thread_id + 1].{projection_field};
+            float4 p2 = primitive_buffer[3*thread_id + 2].{projection_field};
+            int4 tiles = triangle_tile_bounds(p0, p1, p2, viewport_dim);
+            if ((tiles.z - tiles.x + 1) * (tiles.w - tiles.y + 1) > {__LARGE_TRIANGLE_TILES__})
+                return; // listed as large triangle
+            if (triangle_is_small(p0, p1, p2, viewport_dim, small_pixels))
+                return; // listed as small triangle
+            uint min_depth = triangle_min_depth(p0, p1, p2);
+            int tiles_x = (viewport_dim.x + {__TILE_SIZE__ - 1}) / {__TILE_SIZE__};
+            for (int ty = tiles.y; ty <= tiles.w; ty++)
+                for (int tx = tiles.x; tx <= tiles.z; tx++)
+                {{
+                    int tile = ty * tiles_x + tx;
+                    if (min_depth <= hiz[tile])
+                        tile_entries[tile_offsets[tile] + atomic_inc(tile_fill + tile)] = thread_id;
+                }}
+            """
         )
+        __TILING_CACHE__[vertex_type] = count_kernel, scatter_kernel
+    return __TILING_CACHE__[vertex_type]
 
-        __RASTER_CACHE__[vertex_type] = point_raster_kernel, None, triangle_raster_kernel  # Point, Line, Triangle rasters
-    return __RASTER_CACHE__[vertex_type]
+
+def _tile_raster_body(vertex_type: np.dtype, visible_code: str):
+    """
+    Code of a kernel where a work-group rasterizes a tile, every thread owns a pixel. Triangles binned to the tile,
+    followed by large triangles overlapping it, are loaded in chunks to local memory. Once all triangles were depth
+    tested, visible_code handles the closest fragment of the pixel (winner) if any.
+    Kernels using it must declare int2 dim with the viewport size, and statistics and overdraw buffers (maybe null).
+    """
+    cl_vertex_name = cltools.dtype_to_ctype(vertex_type)
+    projection_field = [k for k, (d, offset) in vertex_type.fields.items() if offset == 0][0]
+    return f"""
+            __local float4 chunk_proj[3 * {__TILE_PIXELS__}];
+            __local float4 chunk_edges[3 * {__TILE_PIXELS__}];
+            __local float4 chunk_bounds[{__TILE_PIXELS__}];
+            __local uchar chunk_top_left[{__TILE_PIXELS__}];
+            __local int chunk_primitive[{__TILE_PIXELS__}];
+            __local uint tile_depth[{__TILE_PIXELS__}];
+            __local uint tile_max_depth;
+
+            int tile = thread_id / {__TILE_PIXELS__};
+            int local_id = thread_id % {__TILE_PIXELS__};
+            int tiles_x = (dim.x + {__TILE_SIZE__ - 1}) / {__TILE_SIZE__};
+            int col = (tile % tiles_x) * {__TILE_SIZE__} + local_id % {__TILE_SIZE__};
+            int row = (tile / tiles_x) * {__TILE_SIZE__} + local_id / {__TILE_SIZE__};
+            bool inside = col < dim.x && row < dim.y; // threads out of the viewport still join barriers
+            tile_depth[local_id] = inside ? depth_buffer[row * dim.x + col] : 0;
+            float px = col + 0.5f;
+            float py = row + 0.5f; // set at the middle of the pixel
+
+            int winner = -1; // primitive currently written in the pixel
+            bool winner_swapped;
+            float4 winner_proj;
+            float2 winner_alpha; // perspective correct barycentric coordinates of 2nd and 3rd vertices
+            int covered = 0; // fragments generated in the pixel
+            int passed = 0; // fragments closer than the previous ones
+            uint tile_hiz = hiz[tile];
+            int start = tile_offsets[tile];
+            int binned_end = tile_offsets[tile + 1];
+            int end = binned_end + *large_count;
+            int4 tile_bounds = (int4)(tile % tiles_x, tile / tiles_x, tile % tiles_x, tile / tiles_x);
+            for (int chunk = start; chunk < end; chunk += {__TILE_PIXELS__})
+            {{
+                barrier(CLK_LOCAL_MEM_FENCE);
+                chunk_primitive[local_id] = {__NO_PRIMITIVE__};
+                if (chunk + local_id < end)
+                {{
+                    int index = chunk + local_id < binned_end ? tile_entries[chunk + local_id] : large_primitives[chunk + local_id - binned_end];
+                    float4 h1 = primitive_buffer[3*index + 0].{projection_field};
+                    float4 h2 = primitive_buffer[3*index + 1].{projection_field};
+                    float4 h3 = primitive_buffer[3*index + 2].{projection_field};
+                    float2 vec1 = h2.xy - h1.xy;
+                    float2 vec2 = h3.xy - h1.xy;
+                    if ((vec1.x * vec2.y - vec1.y * vec2.x) > 0) // Grant is Counterclockwised
+                    {{
+                        float4 temp = h2;
+                        h2 = h3;
+                        h3 = temp;
+                        index = -index - 1; // negative indices mark swapped vertices
+                    }}
+                    chunk_proj[3*local_id + 0] = h1;
+                    chunk_proj[3*local_id + 1] = h2;
+                    chunk_proj[3*local_id + 2] = h3;
+                    // edge equations, top-left flags and pixel bounds are shared by all threads
+                    bool v1v2IsTLE = (h1.y == h2.y && h2.x <= h1.x) || h1.y < h2.y;
+                    bool v2v3IsTLE = (h2.y == h3.y && h3.x <= h2.x) || h2.y < h3.y;
+                    bool v3v1IsTLE = (h3.y == h1.y && h1.x <= h3.x) || h3.y < h1.y;
+                    chunk_edges[3*local_id + 0] = edge_equation(h1, h2);
+                    chunk_edges[3*local_id + 1] = edge_equation(h2, h3);
+                    chunk_edges[3*local_id + 2] = edge_equation(h3, h1);
+                    chunk_top_left[local_id] = (v1v2IsTLE ? 1 : 0) | (v2v3IsTLE ? 2 : 0) | (v3v1IsTLE ? 4 : 0);
+                    chunk_bounds[local_id] = (float4)(min(h1.xy, min(h2.xy, h3.xy)), max(h1.xy, max(h2.xy, h3.xy)));
+                    int4 tiles = triangle_tile_bounds(h1, h2, h3, dim);
+                    if (all(tiles.xy <= tile_bounds.xy) && all(tiles.zw >= tile_bounds.zw) // large triangles might not overlap the tile
+                        && triangle_min_depth(h1, h2, h3) <= tile_hiz) // or be hidden
+                        chunk_primitive[local_id] = index;
+                }}
+                barrier(CLK_LOCAL_MEM_FENCE);
+                int chunk_size = min({__TILE_PIXELS__}, end - chunk);
+                for (int i = 0; inside && i < chunk_size; i++)
+                {{
+                    if (chunk_primitive[i] == {__NO_PRIMITIVE__})
+                        continue;
+                    float4 bounds = chunk_bounds[i];
+                    if (px < bounds.x || py < bounds.y || px > bounds.z || py > bounds.w)
+                        continue; // out of the bounding box, edges are not evaluated
+                    float d1 = edge_function(chunk_edges[3*i + 0], px, py);
+                    float d2 = edge_function(chunk_edges[3*i + 1], px, py);
+                    float d3 = edge_function(chunk_edges[3*i + 2], px, py);
+
+                    uchar top_left = chunk_top_left[i];
+                    if (!(edge_inside(d1, top_left & 1) && edge_inside(d2, top_left & 2) && edge_inside(d3, top_left & 4)))
+                        continue; // exterior
+
+                    float alpha3 = d1 / (d1 + d2 + d3);
+                    float alpha1 = d2 / (d1 + d2 + d3);
+                    float alpha2 = d3 / (d1 + d2 + d3);
+
+                    float4 h1 = chunk_proj[3*i + 0];
+                    float4 h2 = chunk_proj[3*i + 1];
+                    float4 h3 = chunk_proj[3*i + 2];
+                    float4 h_int = h1 * alpha1 + h2 * alpha2 + h3 * alpha3;
+                    if (h_int.z <= 0)
+                        continue;
+                    covered++;
+                    uint depth = as_uint(h_int.z);
+                    int index = chunk_primitive[i];
+                    bool swapped = index < 0;
+                    index = swapped ? -index - 1 : index;
+                    // depth test in local memory, ties inside a draw are solved by primitive order
+                    if (depth > tile_depth[local_id] || (depth == tile_depth[local_id] && winner != -1 && index > winner))
+                        continue;
+                    tile_depth[local_id] = depth;
+                    passed++;
+                    winner = index;
+                    winner_swapped = swapped;
+                    winner_proj = h_int;
+                    float beta2 = (alpha2 / h2.w) / (alpha1 / h1.w + alpha2 / h2.w + alpha3 / h3.w);
+                    float beta3 = (alpha3 / h3.w) / (alpha1 / h1.w + alpha2 / h2.w + alpha3 / h3.w);
+                    winner_alpha = (float2)(beta2, beta3);
+                }}
+            }}
+            {visible_code}
+            if (inside && overdraw != 0)
+                overdraw[row * dim.x + col] += covered; // a single thread owns the pixel
+            if (covered > 0)
+            {{
+                {_count_statistic('fragments', 'covered')}
+                {_count_statistic('depth_passed', 'passed')}
+            }}
+            // update the coarse depth of the tile for next batches
+            if (local_id == 0)
+                tile_max_depth = 0;
+            barrier(CLK_LOCAL_MEM_FENCE);
+            if (inside)
+                atomic_max(&tile_max_depth, tile_depth[local_id]);
+            barrier(CLK_LOCAL_MEM_FENCE);
+            if (local_id == 0)
+                hiz[tile] = tile_max_depth;
+            """
+
+
+def _per_draw_globals(globals_type, per_draw: bool, primitive: str):
+    """
+    Arguments and expression of the fragment globals. Draw lists pass an array of globals indexed by the draw of each
+    primitive instead of a single struct.
+    """
+    if per_draw:
+        return {'globals': [globals_type], 'primitive_draws': [np.int32]}, f'globals[primitive_draws[{primitive}]]'
+    return {'globals': globals_type}, 'globals'
+
+
+def _resolve_tile_raster_kernel(vertex_type: np.dtype, globals_type, shader, per_draw: bool = False):
+    if (shader.name, per_draw) not in __TILE_RASTER_CACHE__:
+        cl_vertex_name = cltools.dtype_to_ctype(vertex_type)
+        projection_field = [k for k, (d, offset) in vertex_type.fields.items() if offset == 0][0]
+        globals_arguments, globals_value = _per_draw_globals(globals_type, per_draw, 'winner')
+        k = build_kernel_main(
+            name=f'TileRaster{"List" if per_draw else ""}_{shader.name}',
+            arguments={'primitive_buffer': [vertex_type], 'tile_offsets': [np.int32], 'tile_entries': [np.int32],
+                       'large_count': [np.int32], 'large_primitives': [np.int32], **globals_arguments, 'render_target': w_image2d_t, 'depth_buffer': [np.uint32],
+                       'hiz': [np.uint32], 'statistics': [np.uint32], 'overdraw': [np.uint32]},
+            group_size=__TILE_PIXELS__,
+            body=f"""
+            // Only the closest fragment of every pixel is shaded
+            int2 dim = get_image_dim(render_target);
+            """ + _tile_raster_body(vertex_type, f"""
+            if (winner != -1)
+            {{
+                {cl_vertex_name} v1 = primitive_buffer[3*winner + 0];
+                {cl_vertex_name} v2 = primitive_buffer[3*winner + (winner_swapped ? 2 : 1)];
+                {cl_vertex_name} v3 = primitive_buffer[3*winner + (winner_swapped ? 1 : 2)];
+                {cl_vertex_name} fragment = interpolate3_{cl_vertex_name}(v1, v2, v3, winner_alpha);
+                fragment.{projection_field} = winner_proj;
+                float4 color = {shader.name}(fragment, {globals_value});
+                depth_buffer[row * dim.x + col] = tile_depth[local_id];
+                write_imagef(render_target, (int2)(col, row), color);
+                {_count_statistic('shaded_fragments')}
+            }}
+            """)
+        )
+        __TILE_RASTER_CACHE__[(shader.name, per_draw)] = k
+    return __TILE_RASTER_CACHE__[(shader.name, per_draw)]
+
+
+def _small_triangle_raster_body(vertex_type: np.dtype, fragment_code: str):
+    """
+    Code of a kernel where every thread rasterizes a small triangle (see triangle_is_small) walking the pixels of its
+    bounding box, at most __SMALL_TRIANGLE_PIXELS__ inside a single tile. fragment_code runs for every covered pixel
+    with the fragment depth, the pixel and the (possibly swapped) triangle index.
+    Kernels using it run once for depth and again to shade, both passes must compute exactly the same depths, so
+    floating point contraction (fma) is disabled.
+    Kernels using it must declare int2 dim with the viewport size.
+    """
+    projection_field = [k for k, (d, offset) in vertex_type.fields.items() if offset == 0][0]
+    return f"""
+            {{
+            #pragma OPENCL FP_CONTRACT OFF
+            int index = small_primitives[thread_id];
+            float4 h1 = primitive_buffer[3*index + 0].{projection_field};
+            float4 h2 = primitive_buffer[3*index + 1].{projection_field};
+            float4 h3 = primitive_buffer[3*index + 2].{projection_field};
+            float2 vec1 = h2.xy - h1.xy;
+            float2 vec2 = h3.xy - h1.xy;
+            bool swapped = (vec1.x * vec2.y - vec1.y * vec2.x) > 0; // Grant is Counterclockwised
+            if (swapped)
+            {{
+                float4 temp = h2;
+                h2 = h3;
+                h3 = temp;
+            }}
+            int4 bounds = triangle_pixel_bounds(h1, h2, h3, dim);
+
+            float4 e1 = edge_equation(h1, h2);
+            float4 e2 = edge_equation(h2, h3);
+            float4 e3 = edge_equation(h3, h1);
+
+            bool v1v2IsTLE = (h1.y == h2.y && h2.x <= h1.x) || h1.y < h2.y;
+            bool v2v3IsTLE = (h2.y == h3.y && h3.x <= h2.x) || h2.y < h3.y;
+            bool v3v1IsTLE = (h3.y == h1.y && h1.x <= h3.x) || h3.y < h1.y;
+
+            for (int row = bounds.y; row <= bounds.w; row++)
+                for (int col = bounds.x; col <= bounds.z; col++)
+                {{
+                    float px = col + 0.5f;
+                    float py = row + 0.5f; // set at the middle of the pixel
+
+                    float d1 = edge_function(e1, px, py);
+                    float d2 = edge_function(e2, px, py);
+                    float d3 = edge_function(e3, px, py);
+
+                    if (!(edge_inside(d1, v1v2IsTLE) && edge_inside(d2, v2v3IsTLE) && edge_inside(d3, v3v1IsTLE)))
+                        continue; // exterior
+
+                    float alpha3 = d1 / (d1 + d2 + d3);
+                    float alpha1 = d2 / (d1 + d2 + d3);
+                    float alpha2 = d3 / (d1 + d2 + d3);
+
+                    float4 h_int = h1 * alpha1 + h2 * alpha2 + h3 * alpha3;
+                    if (h_int.z <= 0)
+                        continue;
+                    uint depth = as_uint(h_int.z);
+                    int pixel = row * dim.x + col;
+                    {fragment_code}
+                }}
+            }}
+            """
+
+
+def _resolve_small_triangle_kernels(vertex_type: np.dtype):
+    """
+    Kernels of small triangles shared by all shaders: the depth pass, run before the tiles, and the pass writing the
+    closest primitive of every pixel in the visibility buffer, run after the tiles.
+    """
+    if vertex_type not in __SMALL_TRIANGLE_CACHE__:
+        cl_vertex_name = cltools.dtype_to_ctype(vertex_type)
+        depth_kernel = build_kernel_main(
+            name=f'SmallTriangleDepth_{cl_vertex_name}',
+            arguments={'primitive_buffer': [vertex_type], 'small_primitives': [np.int32], 'viewport_dim': int2, 'depth_buffer': [np.uint32],
+                       'statistics': [np.uint32], 'overdraw': [np.uint32]},
+            body=f"""
+            int2 dim = viewport_dim;
+            int covered = 0; // fragments generated by the triangle
+            int passed = 0; // fragments closer than the previous ones
+            """ + _small_triangle_raster_body(vertex_type, """
+                    covered++;
+                    if (atomic_min(depth_buffer + pixel, depth) >= depth)
+                        passed++;
+                    if (overdraw != 0)
+                        atomic_inc(overdraw + pixel);
+            """) + f"""
+            if (statistics != 0)
+            {{
+                {_count_statistic('fragments', 'covered')}
+                {_count_statistic('depth_passed', 'passed')}
+            }}
+            """
+        )
+        visibility_kernel = build_kernel_main(
+            name=f'SmallTriangleVisibility_{cl_vertex_name}',
+            arguments={'primitive_buffer': [vertex_type], 'small_primitives': [np.int32], 'viewport_dim': int2, 'depth_buffer': [np.uint32],
+                       'visibility_buffer': [np.uint64]},
+            body=f"""
+            int2 dim = viewport_dim;
+            """ + _small_triangle_raster_body(vertex_type, """
+                    if (depth == depth_buffer[pixel]) // closest fragment, ties are solved by the last write
+                        visibility_buffer[pixel] = ((ulong)depth << 32) | (uint)index;
+            """)
+        )
+        __SMALL_TRIANGLE_CACHE__[vertex_type] = depth_kernel, visibility_kernel
+    return __SMALL_TRIANGLE_CACHE__[vertex_type]
+
+
+def _resolve_small_triangle_raster_kernel(vertex_type: np.dtype, globals_type, shader, per_draw: bool = False):
+    if (shader.name, per_draw) not in __SMALL_TRIANGLE_RASTER_CACHE__:
+        cl_vertex_name = cltools.dtype_to_ctype(vertex_type)
+        projection_field = [k for k, (d, offset) in vertex_type.fields.items() if offset == 0][0]
+        globals_arguments, globals_value = _per_draw_globals(globals_type, per_draw, 'index')
+        k = build_kernel_main(
+            name=f'SmallTriangleRaster{"List" if per_draw else ""}_{shader.name}',
+            arguments={'primitive_buffer': [vertex_type], 'small_primitives': [np.int32], **globals_arguments, 'render_target': w_image2d_t,
+                       'depth_buffer': [np.uint32], 'statistics': [np.uint32]},
+            body=f"""
+            // runs after the depth pass and the tiles, only fragments at the final depth of the pixel are shaded
+            int2 dim = get_image_dim(render_target);
+            """ + _small_triangle_raster_body(vertex_type, f"""
+                    if (depth != depth_buffer[pixel])
+                        continue; // hidden
+                    float beta2 = (alpha2 / h2.w) / (alpha1 / h1.w + alpha2 / h2.w + alpha3 / h3.w);
+                    float beta3 = (alpha3 / h3.w) / (alpha1 / h1.w + alpha2 / h2.w + alpha3 / h3.w);
+                    {cl_vertex_name} v1 = primitive_buffer[3*index + 0];
+                    {cl_vertex_name} v2 = primitive_buffer[3*index + (swapped ? 2 : 1)];
+                    {cl_vertex_name} v3 = primitive_buffer[3*index + (swapped ? 1 : 2)];
+                    {cl_vertex_name} fragment = interpolate3_{cl_vertex_name}(v1, v2, v3, (float2)(beta2, beta3));
+                    fragment.{projection_field} = h_int;
+                    write_imagef(render_target, (int2)(col, row), {shader.name}(fragment, {globals_value}));
+                    {_count_statistic('shaded_fragments')}
+            """)
+        )
+        __SMALL_TRIANGLE_RASTER_CACHE__[(shader.name, per_draw)] = k
+    return __SMALL_TRIANGLE_RASTER_CACHE__[(shader.name, per_draw)]
+
+
+__EMPTY_VISIBILITY__ = 0xFFFFFFFFFFFFFFFF  # packed (depth, primitive) of pixels without fragments
+
+
+def _resolve_visibility_kernels(vertex_type: np.dtype, globals_type, shader):
+    """
+    Kernels of the visibility buffer mode. Rasters write the closest (depth << 32 | primitive) of every pixel and a
+    screen pass interpolates and shades only the visible fragment of each pixel, resetting the visibility buffer.
+    """
+    cl_vertex_name = cltools.dtype_to_ctype(vertex_type)
+    projection_field = [k for k, (d, offset) in vertex_type.fields.items() if offset == 0][0]
+    if vertex_type not in __VISIBILITY_CACHE__:
+        tile_visibility = build_kernel_main(
+            name=f'TileVisibility_{cl_vertex_name}',
+            arguments={'primitive_buffer': [vertex_type], 'tile_offsets': [np.int32], 'tile_entries': [np.int32],
+                       'large_count': [np.int32], 'large_primitives': [np.int32], 'viewport_dim': int2, 'depth_buffer': [np.uint32],
+                       'hiz': [np.uint32], 'visibility_buffer': [np.uint64], 'statistics': [np.uint32], 'overdraw': [np.uint32]},
+            group_size=__TILE_PIXELS__,
+            body=f"""
+            int2 dim = viewport_dim;
+            """ + _tile_raster_body(vertex_type, """
+            if (winner != -1)
+            {
+                depth_buffer[row * dim.x + col] = tile_depth[local_id];
+                visibility_buffer[row * dim.x + col] = ((ulong)tile_depth[local_id] << 32) | (uint)winner;
+            }
+            """)
+        )
+        point_visibility = build_kernel_main(
+            name=f'PointVisibility_{cl_vertex_name}',
+            arguments={'in_fragments': [vertex_type], 'viewport_dim': int2, 'depth_buffer': [np.uint32],
+                       'visibility_buffer': [np.uint64], 'statistics': [np.uint32], 'overdraw': [np.uint32]},
+            body=f"""
+            float4 proj = in_fragments[thread_id].{projection_field};
+            if (proj.z <= 0)
+                return;
+            if (proj.x < 0 || proj.x >= viewport_dim.x || proj.y < 0 || proj.y >= viewport_dim.y) // clipping
+                return;
+            int pixel = (int)proj.y * viewport_dim.x + (int)proj.x;
+            uint depth = as_uint(proj.z);
+            atomic_min(depth_buffer + pixel, depth);
+            {_count_statistic('fragments')}
+            if (overdraw != 0)
+                atomic_inc(overdraw + pixel);
+            #ifdef cl_khr_int64_extended_atomics
+            atom_min(visibility_buffer + pixel, ((ulong)depth << 32) | (uint)thread_id);
+            #endif
+            """
+        )
+        __VISIBILITY_CACHE__[vertex_type] = tile_visibility, point_visibility
+    tile_visibility, point_visibility = __VISIBILITY_CACHE__[vertex_type]
+    if shader.name not in __POINT_VISIBILITY_RESOLVE_CACHE__:
+        point_resolve = build_kernel_main(
+            name=f'PointVisibilityResolve_{shader.name}',
+            arguments={'in_fragments': [vertex_type], 'visibility_buffer': [np.uint64], 'depth_buffer': [np.uint32],
+                       'globals': globals_type, 'render_target': w_image2d_t, 'statistics': [np.uint32]},
+            body=f"""
+            ulong visible = visibility_buffer[thread_id];
+            if (visible == {__EMPTY_VISIBILITY__}UL)
+                return;
+            visibility_buffer[thread_id] = {__EMPTY_VISIBILITY__}UL; // ready for next batch
+            if ((uint)(visible >> 32) != depth_buffer[thread_id])
+                return; // hidden by a previous draw
+            {_count_statistic('depth_passed')}
+            {_count_statistic('shaded_fragments')}
+            int2 dim = get_image_dim(render_target);
+            write_imagef(render_target, (int2)(thread_id % dim.x, thread_id / dim.x),
+                {shader.name}(in_fragments[(int)(visible & 0xFFFFFFFF)], globals));
+            """
+        )
+        __POINT_VISIBILITY_RESOLVE_CACHE__[shader.name] = point_resolve
+    triangle_resolve = _resolve_visibility_resolve_kernel(vertex_type, globals_type, shader)
+    return tile_visibility, triangle_resolve, point_visibility, __POINT_VISIBILITY_RESOLVE_CACHE__[shader.name]
+
+
+def _resolve_visibility_resolve_kernel(vertex_type: np.dtype, globals_type, shader, per_draw: bool = False):
+    if (shader.name, per_draw) not in __VISIBILITY_RESOLVE_CACHE__:
+        cl_vertex_name = cltools.dtype_to_ctype(vertex_type)
+        projection_field = [k for k, (d, offset) in vertex_type.fields.items() if offset == 0][0]
+        globals_arguments, globals_value = _per_draw_globals(globals_type, per_draw, 'index')
+        k = build_kernel_main(
+            name=f'VisibilityResolve{"List" if per_draw else ""}_{shader.name}',
+            arguments={'primitive_buffer': [vertex_type], 'visibility_buffer': [np.uint64], **globals_arguments,
+                       'render_target': w_image2d_t, 'statistics': [np.uint32]},
+            body=f"""
+            ulong visible = visibility_buffer[thread_id];
+            if (visible == {__EMPTY_VISIBILITY__}UL)
+                return;
+            visibility_buffer[thread_id] = {__EMPTY_VISIBILITY__}UL; // ready for next batch
+            int index = (int)(visible & 0xFFFFFFFF);
+            int2 dim = get_image_dim(render_target);
+            int col = thread_id % dim.x;
+            int row = thread_id / dim.x;
+            float px = col + 0.5f;
+            float py = row + 0.5f;
+            float4 h1 = primitive_buffer[3*index + 0].{projection_field};
+            float4 h2 = primitive_buffer[3*index + 1].{projection_field};
+            float4 h3 = primitive_buffer[3*index + 2].{projection_field};
+            float2 vec1 = h2.xy - h1.xy;
+            float2 vec2 = h3.xy - h1.xy;
+            bool swapped = (vec1.x * vec2.y - vec1.y * vec2.x) > 0; // same order used by the raster
+            if (swapped)
+            {{
+                float4 temp = h2;
+                h2 = h3;
+                h3 = temp;
+            }}
+            // barycentric coordinates reconstructed from the edge functions at the pixel center
+            float d1 = edge_function(edge_equation(h1, h2), px, py);
+            float d2 = edge_function(edge_equation(h2, h3), px, py);
+            float d3 = edge_function(edge_equation(h3, h1), px, py);
+            float alpha3 = d1 / (d1 + d2 + d3);
+            float alpha1 = d2 / (d1 + d2 + d3);
+            float alpha2 = d3 / (d1 + d2 + d3);
+            float4 h_int = h1 * alpha1 + h2 * alpha2 + h3 * alpha3;
+            float beta2 = (alpha2 / h2.w) / (alpha1 / h1.w + alpha2 / h2.w + alpha3 / h3.w);
+            float beta3 = (alpha3 / h3.w) / (alpha1 / h1.w + alpha2 / h2.w + alpha3 / h3.w);
+            {cl_vertex_name} v1 = primitive_buffer[3*index + 0];
+            {cl_vertex_name} v2 = primitive_buffer[3*index + (swapped ? 2 : 1)];
+            {cl_vertex_name} v3 = primitive_buffer[3*index + (swapped ? 1 : 2)];
+            {cl_vertex_name} fragment = interpolate3_{cl_vertex_name}(v1, v2, v3, (float2)(beta2, beta3));
+            fragment.{projection_field} = h_int;
+            write_imagef(render_target, (int2)(col, row), {shader.name}(fragment, {globals_value}));
+            {_count_statistic('shaded_fragments')}
+            """
+        )
+        __VISIBILITY_RESOLVE_CACHE__[(shader.name, per_draw)] = k
+    return __VISIBILITY_RESOLVE_CACHE__[(shader.name, per_draw)]
+
+
+__OVERDRAW_HEATMAP__ = build_kernel_main(
+    name='OverdrawHeatmap',
+    arguments={'overdraw': [np.uint32], 'image': w_image2d_t, 'max_overdraw': np.int32},
+    body="""
+    int2 dim = get_image_dim(image);
+    uint fragments = overdraw[thread_id];
+    float t = clamp((float)fragments / max(1, max_overdraw), 0.0f, 1.0f);
+    float4 color = fragments == 0 ? (float4)(0, 0, 0, 1) :
+        (float4)(clamp(2 * t - 1, 0.0f, 1.0f), 1 - fabs(2 * t - 1), clamp(1 - 2 * t, 0.0f, 1.0f), 1);
+    write_imagef(image, (int2)(thread_id % dim.x, thread_id / dim.x), color);
+    """
+)
 
 
-# def _resolve_tiling_kernel(vertex_type: np.dtype):
-#     if vertex_type not in __TILING_CACHE__:
-#         cl_vertex_name = cltools.dtype_to_ctype(vertex_type)
-#         projection_field = [k for k, (d, offset) in vertex_type.fields.items() if offset == 0][0]
-#         triangle_tiling_kernel = build_kernel_main(
-#             name=f'Tiling_{cl_vertex_name}',
-#             arguments={'primitive_buffer': [vertex_type], 'count': [np.int32],
-#                        'fragment_buffer': [vertex_type]},
-#             body=f"""
-#                     int index = thread_id;
-#                     float4 proj = primitive_buffer[index].{projection_field};
-#                     if (proj.x < -proj.w || proj.x > proj.w || proj.y < -proj.w || proj.y > proj.w) // clipping
-#                         return;
-#                     int out_index = atomic_add(count, 1);
-#                     fragment_buffer[out_index] = primitive_buffer[index];
-#                             """
-#         )
-#         __TILING_CACHE__[vertex_type] = triangle_tiling_kernel
-#     return __TILING_CACHE__[vertex_type]
+class ScratchArena:
+    """
+    Scratch buffers used by rasters while drawing. Buffers are requested by name on every draw and only grow when a
+    draw needs more than the current capacity, so memory follows the peak usage until trim is called. Rasters drawing
+    one after the other can share the same arena.
+    Device counters (e.g. visible primitives) are tracked with non-blocking reads resolved later, to report how much
+    of the requested memory was used without synchronizing the draws.
+    """
+    def __init__(self, growth: float = 1.5):
+        self.growth = growth
+        self.memory = { }  # name -> raw buffer
+        self.views = { }  # (name, dtype) -> array over the raw buffer
+        self.requested = { }  # name -> peak of bytes requested
+        self.recent = { }  # name -> peak of bytes requested since the last trim
+        self.used = { }  # name -> peak of elements counted in device
+        self.pending_reads = [ ]  # (name, host value, event)
+
+    def get(self, name: str, count: int, dtype: np.dtype):
+        dtype = np.dtype(dtype)
+        size = max(1, count) * dtype.itemsize
+        self.requested[name] = max(self.requested.get(name, 0), size)
+        self.recent[name] = max(self.recent.get(name, 0), size)
+        memory = self.memory.get(name)
+        if memory is None or memory.size < size:
+            capacity = size if memory is None else max(size, int(memory.size * self.growth))
+            capacity = (capacity + 255) // 256 * 256  # clearing fills whole buffers with patterns up to 128 bytes
+            memory = self.memory[name] = create_buffer(capacity, np.uint8)
+            self.views = {key: view for key, view in self.views.items() if key[0] != name}
+        view = self.views.get((name, dtype))
+        if view is None:
+            view = self.views[(name, dtype)] = cla.Array(get_queue(), (memory.size // dtype.itemsize,), dtype, data=memory.base_data)
+        return view
+
+    def trim(self):
+        """
+        Releases the buffers not requested since the previous trim and the ones larger than the growth factor over
+        the peak requested since then, they are allocated again with the recent size when needed. Calling it every
+        few frames bounds the memory to the recent peak instead of the largest draw ever seen.
+        """
+        for name, memory in list(self.memory.items()):
+            if memory.size > (int(self.recent.get(name, 0) * self.growth) + 255) // 256 * 256:
+                del self.memory[name]
+                self.views = {key: view for key, view in self.views.items() if key[0] != name}
+        self.recent = { }
+
+    def get_counter(self, name: str):
+        """
+        Buffer with a single int32 reset to 0.
+        """
+        counter = self.get(name, 1, np.int32)
+        clear(counter, np.int32(0))
+        return counter
+
+    def track(self, name: str, counter):
+        """
+        Enqueues a non-blocking read of a device counter to update the peak usage of a buffer.
+        """
+        self._resolve_reads(wait=False)
+        value = np.zeros(1, np.int32)
+        self.pending_reads.append((name, value, read_buffer_async(counter, value)))
+
+    def _resolve_reads(self, wait: bool):
+        pending = [ ]
+        for name, value, event in self.pending_reads:
+            if wait:
+                event.wait()
+            elif event.command_execution_status != cl.command_execution_status.COMPLETE:
+                pending.append((name, value, event))
+                continue
+            self.used[name] = max(self.used.get(name, 0), int(value[0]))
+        self.pending_reads = pending
+
+    def get_statistics(self) -> typing.Dict[str, typing.Dict[str, int]]:
+        """
+        High-water marks per buffer: capacity and peak requested bytes, and the peak count used in device if tracked.
+        """
+        with trace_span('scratch_statistics', 'sync'):
+            self._resolve_reads(wait=True)
+        return {
+            name: {
+                'capacity_bytes': memory.size,
+                'peak_requested_bytes': self.requested[name],
+                **({'peak_used': self.used[name]} if name in self.used else { })
+            }
+            for name, memory in self.memory.items()
+        }
+
+    def get_allocated_bytes(self) -> int:
+        return sum(memory.size for memory in self.memory.values())
+
 
 class Raster:
 
-    def __init__(self, render_target, vertex_shader, vertex_shader_globals, fragment_shader, fragment_shader_globals):
+    def __init__(self, render_target, vertex_shader, vertex_shader_globals, fragment_shader, fragment_shader_globals,
+                 scratch: ScratchArena = None):
         self._render_target = render_target
         self._depth_buffer = create_buffer(render_target.width * render_target.height, np.uint32)
         self._fill_mode = FillMode.WIREFRAME
+        self._cull_mode = CullMode.NONE
+        self._shading_mode = ShadingMode.FORWARD
+        self._small_triangle_pixels = __SMALL_TRIANGLE_PIXELS__
+        self._visibility_buffer = None  # packed (depth, primitive) per pixel, created the first time it is used
+        self._culled = create_buffer(2, np.int32)  # triangles rejected by frustum and by face orientation
+        self._collect_statistics = False
+        self._statistics = None  # device counters of the draw in progress, None when not collected
+        self._draw_statistics = []  # (primitive, counters, batches) of every draw since the last reset
+        self._collect_overdraw = False
+        self._overdraw = None  # fragments generated per pixel, created the first time it is used
 
-        assert len(vertex_shader.signature) == 2 and vertex_shader.return_annotation is not None, "Vertex shader signature incorrect. Must receive one argument with vertex type and another with globals type, and return another struct"
+        assert len(vertex_shader.signature) in (2, 3, 4) and vertex_shader.return_annotation is not None, "Vertex shader signature incorrect. Must receive one argument with vertex type and another with globals type, optionally the instance struct and the instance id for instanced draws, and return another struct"
+        assert len(vertex_shader.signature) < 4 or vertex_shader.signature[3][1].annotation in (np.int32, int), "Instance id must be an int"
         assert len(fragment_shader.signature) == 2 and fragment_shader.return_annotation==float4, "Fragment shader signature incorrect. Must receive one argument with fragment type and another with globals type, and return a float4"
         self.vertex_input_type = vertex_shader.signature[0][1].annotation
-        vertex_globals_type = vertex_shader.signature[1][1].annotation
+        self.vertex_globals_type = vertex_globals_type = vertex_shader.signature[1][1].annotation
         self.vertex_output_type = vertex_shader.return_annotation
         _resolve_interpolators_2(self.vertex_output_type)
         _resolve_interpolators_3(self.vertex_output_type)
         assert fragment_shader.signature[0][1].annotation == self.vertex_output_type, "Vertex shader output must be the same type than fragment shader input."
-        fragment_globals_type = fragment_shader.signature[1][1].annotation
-        self.vertex_kernel = _resolve_vertex_kernel(self.vertex_input_type, vertex_globals_type, self.vertex_output_type, vertex_shader)
+        self.fragment_globals_type = fragment_globals_type = fragment_shader.signature[1][1].annotation
+        self.instance_type = vertex_shader.signature[2][1].annotation if len(vertex_shader.signature) > 2 else None
+        self.vertex_kernel = _resolve_vertex_kernel(self.vertex_input_type, vertex_globals_type, self.vertex_output_type, vertex_shader, self.instance_type)
         self.depth_test, self.fragment_kernel = _resolve_fragment_kernel(self.vertex_output_type, fragment_globals_type, fragment_shader)
         self.vertex_shader_globals = vertex_shader_globals
         self.fragment_shader_globals = fragment_shader_globals
@@ -374,13 +1166,26 @@ class Raster:
         self.point_primitive, self.line_primitive, self.triangle_primitive = _resolve_primitive_assembly_and_clipping_z0(self.vertex_output_type)
         self.point_raster, self.line_raster, self.triangle_raster = _resolve_raster_kernels(self.vertex_output_type)
 
-        # Buffers for streaming
-        self.fragments_capacity = 32 * self._render_target.width * self._render_target.height
-        self.out_fragment_buffer = create_buffer(self.fragments_capacity, self.vertex_output_type)
-        self.primitive_capacity = 200000
-        self.out_vertex_buffer = create_buffer(self.primitive_capacity * 3, self.vertex_output_type)
-        self.out_primitive_buffer = create_buffer(self.primitive_capacity * 2 * 3, self.vertex_output_type)
+        self.tile_count_kernel, self.tile_scatter_kernel = _resolve_tile_binning_kernels(self.vertex_output_type)
+        self.tile_raster_kernel = _resolve_tile_raster_kernel(self.vertex_output_type, fragment_globals_type, fragment_shader)
+        self.tile_visibility_kernel, self.visibility_resolve, self.point_visibility_kernel, self.point_visibility_resolve = \
+            _resolve_visibility_kernels(self.vertex_output_type, fragment_globals_type, fragment_shader)
+        self.small_depth_kernel, self.small_visibility_kernel = _resolve_small_triangle_kernels(self.vertex_output_type)
+        self.small_raster_kernel = _resolve_small_triangle_raster_kernel(self.vertex_output_type, fragment_globals_type, fragment_shader)
+        if self.instance_type is None:
+            # draw list variants reading the globals of every draw from arrays
+            self.vertex_list_kernel = _resolve_vertex_kernel(self.vertex_input_type, vertex_globals_type, self.vertex_output_type, vertex_shader, per_draw=True)
+            self.tile_raster_list_kernel = _resolve_tile_raster_kernel(self.vertex_output_type, fragment_globals_type, fragment_shader, per_draw=True)
+            self.small_raster_list_kernel = _resolve_small_triangle_raster_kernel(self.vertex_output_type, fragment_globals_type, fragment_shader, per_draw=True)
+            self.visibility_resolve_list = _resolve_visibility_resolve_kernel(self.vertex_output_type, fragment_globals_type, fragment_shader, per_draw=True)
 
+        # Scratch memory for streaming and tile binning
+        self.primitive_capacity = 200000  # maximum primitives per batch
+        self.scratch = ScratchArena() if scratch is None else scratch
+        self.tiles_x = (self._render_target.width + __TILE_SIZE__ - 1) // __TILE_SIZE__
+        self.tiles_y = (self._render_target.height + __TILE_SIZE__ - 1) // __TILE_SIZE__
+        self.number_of_tiles = self.tiles_x * self.tiles_y
+        self._hiz = create_buffer(self.number_of_tiles, np.uint32)  # farthest depth per tile
 
     def get_render_target(self):
         return self._render_target
@@ -388,6 +1193,9 @@ class Raster:
     def get_depth_buffer(self):
         return self._depth_buffer
 
+    def get_scratch(self) -> ScratchArena:
+        return self.scratch
+
     @property
     def fill_mode(self) -> FillMode:
         return self._fill_mode
@@ -396,46 +1204,337 @@ class Raster:
     def fill_mode(self, value: FillMode):
         self._fill_mode = value
 
+    @property
+    def cull_mode(self) -> CullMode:
+        return self._cull_mode
+
+    @cull_mode.setter
+    def cull_mode(self, value: CullMode):
+        self._cull_mode = value
+
+    @property
+    def shading_mode(self) -> ShadingMode:
+        return self._shading_mode
+
+    @shading_mode.setter
+    def shading_mode(self, value: ShadingMode):
+        self._shading_mode = value
+
+    @property
+    def small_triangle_pixels(self) -> int:
+        """
+        Triangles with pixel bounds inside a single tile and covering up to this number of pixels are rastered by a
+        thread each instead of being binned. 0 bins every triangle.
+        """
+        return self._small_triangle_pixels
+
+    @small_triangle_pixels.setter
+    def small_triangle_pixels(self, value: int):
+        assert 0 <= value <= __TILE_PIXELS__, "Small triangles must fit in a tile"
+        self._small_triangle_pixels = value
+
+    def _get_visibility_buffer(self):
+        if self._visibility_buffer is None:
+            self._visibility_buffer = create_buffer(self._render_target.width * self._render_target.height, np.uint64)
+            clear(self._visibility_buffer, np.uint64(__EMPTY_VISIBILITY__))
+        return self._visibility_buffer
+
+    def get_culling_statistics(self) -> typing.Dict[str, int]:
+        """
+        Triangles culled since the raster was created or the statistics were reset. Reading them synchronizes with the device.
+        """
+        frustum, face = self._culled.get()
+        return {'frustum': int(frustum), 'face': int(face)}
+
+    def reset_culling_statistics(self):
+        clear(self._culled, np.int32(0))
+
+    @property
+    def collect_statistics(self) -> bool:
+        return self._collect_statistics
+
+    @collect_statistics.setter
+    def collect_statistics(self, value: bool):
+        self._collect_statistics = value
+
+    @property
+    def collect_overdraw(self) -> bool:
+        return self._collect_overdraw
+
+    @collect_overdraw.setter
+    def collect_overdraw(self, value: bool):
+        self._collect_overdraw = value
+
+    def _begin_statistics(self, primitive: str):
+        if self._collect_statistics:
+            self._statistics = create_buffer(len(__PIPELINE_STATISTICS__), np.uint32)
+            self._draw_statistics.append([primitive, self._statistics, 0])
+
+    def _count_batch(self):
+        if self._statistics is not None:
+            self._draw_statistics[-1][2] += 1
+
+    def get_pipeline_statistics(self) -> typing.List[typing.Dict[str, typing.Union[str, int]]]:
+        """
+        Counters of every draw since collect_statistics was enabled or the statistics were reset. Batches is the number
+        of times the raster stages ran for the draw. Reading them synchronizes with the device.
+        """
+        return [
+            {'primitive': primitive, 'batches': batches, **{name: int(c) for name, c in zip(__PIPELINE_STATISTICS__, counters.get())}}
+            for primitive, counters, batches in self._draw_statistics
+        ]
+
+    def reset_pipeline_statistics(self):
+        self._draw_statistics = []
+
+    def get_overdraw(self):
+        """
+        Buffer with the number of fragments generated per pixel (before depth test) while collect_overdraw is enabled.
+        """
+        if self._overdraw is None:
+            self._overdraw = create_buffer(self._render_target.width * self._render_target.height, np.uint32)
+        return self._overdraw
+
+    def reset_overdraw(self):
+        clear(self.get_overdraw(), np.uint32(0))
+
+    def _get_overdraw_target(self):
+        return self.get_overdraw() if self._collect_overdraw else None
+
+    def draw_overdraw_heatmap(self, image, max_overdraw: int = 8):
+        """
+        Writes the overdraw in an image of the render target size, from blue (one fragment) to red (max_overdraw or more).
+        """
+        __OVERDRAW_HEATMAP__[self._render_target.width * self._render_target.height](self.get_overdraw(), image, np.int32(max_overdraw))
+
+    def _process_vertices(self, vertex_buffer, instance_buffer, out_vertices, first_vertex, count):
+        if instance_buffer is None:
+            self.vertex_kernel[count](vertex_buffer, self.vertex_shader_globals, out_vertices, first_vertex)
+        else:
+            self.vertex_kernel[count](vertex_buffer, self.vertex_shader_globals, out_vertices, first_vertex,
+                                      instance_buffer, vertex_buffer.shape[0])
+
+    def _stream_batches(self, vertex_buffer, index_buffer, primitive_count, batch_capacity, vertices_per_primitive,
+                        assembly, assembly_args, raster, instance_buffer = None):
+        """
+        Processes the primitives (of every instance) in batches of batch_capacity to bound the scratch memory of a draw.
+        Every stage after assembly is launched for the worst case and reads the number of primitives from the device, so
+        the whole draw is enqueued without synchronizing. All stages go to the same in-order queue: batches run one after
+        the other, the work of a batch does not overlap with the raster of the previous one.
+        """
+        assert (instance_buffer is None) == (self.instance_type is None), "Instanced draws require a vertex shader receiving the instance and viceversa"
+        instances = 1 if instance_buffer is None else instance_buffer.shape[0]
+        total_primitives = primitive_count * instances
+        if total_primitives == 0:
+            return
+        max_vertices = min(batch_capacity, total_primitives) * vertices_per_primitive
+        # every triangle can be split with z=0 plane
+        primitives = self.scratch.get('primitives', max_vertices * (2 if vertices_per_primitive == 3 else 1), self.vertex_output_type)
+
+        def process_batch(vertices, first, count, vertices_per_instance):
+            primitive_counter = self.scratch.get_counter('primitive_counter')
+            assembly[count](vertices, index_buffer, primitive_counter, primitives, first, primitive_count, vertices_per_instance, *assembly_args,
+                            self._statistics)
+            self.scratch.track('primitives', primitive_counter)
+            raster(primitives, primitive_counter, count)
+
+        if index_buffer is None:
+            # vertices of all instances are streamed one after the other
+            for first in range(0, total_primitives, batch_capacity):
+                count = min(batch_capacity, total_primitives - first)
+                vertices = self.scratch.get('vertices', max_vertices, self.vertex_output_type)
+                self._process_vertices(vertex_buffer, instance_buffer, vertices, first * vertices_per_primitive,
+                                       count * vertices_per_primitive)
+                process_batch(vertices, 0, count, 0)
+        else:
+            # all vertices of a group of instances are processed, then their primitives are assembled in batches
+            vertex_count = vertex_buffer.shape[0]
+            instances_per_group = max(1, batch_capacity // primitive_count)
+            for first_instance in range(0, instances, instances_per_group):
+                group_instances = min(instances_per_group, instances - first_instance)
+                vertices = self.scratch.get('indexed_vertices', vertex_count * group_instances, self.vertex_output_type)
+                self._process_vertices(vertex_buffer, instance_buffer, vertices, first_instance * vertex_count,
+                                       vertex_count * group_instances)
+                group_primitives = primitive_count * group_instances
+                for first in range(0, group_primitives, batch_capacity):
+                    process_batch(vertices, first, min(batch_capacity, group_primitives - first), vertex_count)
+
+    def _raster_points(self, primitives, primitive_counter, count):
+        self._count_batch()
+        fragments = self.scratch.get('fragments', count, self.vertex_output_type)
+        fragment_counter = self.scratch.get_counter('fragment_counter')
+        self.point_raster.indirect(count, primitive_counter)(primitives, fragment_counter, fragments)
+        self.scratch.track('fragments', fragment_counter)
+        self.homogenization.indirect(count, fragment_counter)(fragments, make_float2(self._render_target.width, self._render_target.height), 1)  # inplace modification
+        if self._shading_mode == ShadingMode.VISIBILITY and has_device_extension('cl_khr_int64_extended_atomics'):
+            # closest point of every pixel is selected with 64-bit atomics, otherwise forward shading is used
+            visibility_buffer = self._get_visibility_buffer()
+            self.point_visibility_kernel.indirect(count, fragment_counter)(
+                fragments, make_int2(self._render_target.width, self._render_target.height), self._depth_buffer, visibility_buffer,
+                self._statistics, self._get_overdraw_target())
+            self.point_visibility_resolve[self._render_target.width * self._render_target.height](
+                fragments, visibility_buffer, self._depth_buffer, self.fragment_shader_globals, self._render_target, self._statistics)
+            return
+        self.depth_test.indirect(count, fragment_counter)(fragments, self.fragment_shader_globals, self._render_target, self._depth_buffer,
+                                                          self._statistics, self._get_overdraw_target())
+        self.fragment_kernel.indirect(count, fragment_counter)(fragments, self.fragment_shader_globals, self._render_target, self._depth_buffer,
+                                                               self._statistics)
+
+    def _raster_triangles(self, primitives, primitive_counter, count, primitive_draws = None, fragment_globals = None):
+        self._count_batch()
+        # draw lists shade every primitive with the globals of its draw
+        if primitive_draws is None:
+            globals_args = (self.fragment_shader_globals,)
+            tile_raster_kernel, small_raster_kernel, visibility_resolve = self.tile_raster_kernel, self.small_raster_kernel, self.visibility_resolve
+        else:
+            globals_args = (fragment_globals, primitive_draws)
+            tile_raster_kernel, small_raster_kernel, visibility_resolve = self.tile_raster_list_kernel, self.small_raster_list_kernel, self.visibility_resolve_list
+        max_primitives = count * 2  # every triangle can be split with z=0 plane
+        viewport_dim = make_int2(self._render_target.width, self._render_target.height)
+        self.homogenization.indirect(max_primitives, primitive_counter)(
+            primitives, make_float2(self._render_target.width, self._render_target.height), 3)  # inplace modification
+        # bin triangles into screen tiles (count, scan, scatter), small triangles are listed apart
+        scratch = self.scratch
+        tile_counts = scratch.get('tile_counts', self.number_of_tiles, np.int32)
+        tile_fill = scratch.get('tile_fill', self.number_of_tiles, np.int32)
+        tile_offsets = scratch.get('tile_offsets', self.number_of_tiles + 1, np.int32)
+        # worst case, every triangle of the batch overlaps the maximum tiles to be binned
+        tile_entries = scratch.get('tile_entries', __LARGE_TRIANGLE_TILES__ * max_primitives, np.int32)
+        large_primitives = scratch.get('large_primitives', max_primitives, np.int32)
+        large_count = scratch.get_counter('large_count')
+        small_primitives = scratch.get('small_primitives', max_primitives, np.int32)
+        small_count = scratch.get_counter('small_count')
+        small_pixels = np.int32(self._small_triangle_pixels)
+        clear(tile_counts, np.int32(0))
+        clear(tile_fill, np.int32(0))
+        self.tile_count_kernel.indirect(max_primitives, primitive_counter)(
+            primitives, tile_counts, large_count, large_primitives, small_count, small_primitives, small_pixels,
+            self._hiz, viewport_dim, self._statistics)
+        __TILE_SCAN__[__TILE_PIXELS__](tile_counts, tile_offsets, self.number_of_tiles)
+        scratch.track('tile_entries', tile_offsets[self.number_of_tiles:])
+        scratch.track('large_primitives', large_count)
+        scratch.track('small_primitives', small_count)
+        self.tile_scatter_kernel.indirect(max_primitives, primitive_counter)(
+            primitives, tile_offsets, tile_fill, tile_entries, small_pixels, self._hiz, viewport_dim)
+        # small triangles write their depth first, so tiles test against them and they are shaded (or marked
+        # visible) after the tiles only where they are still the closest
+        self.small_depth_kernel.indirect(max_primitives, small_count)(
+            primitives, small_primitives, viewport_dim, self._depth_buffer, self._statistics, self._get_overdraw_target())
+        if self._shading_mode == ShadingMode.VISIBILITY:
+            # a work-group per tile writes the closest primitive per pixel, then a screen pass shades them
+            visibility_buffer = self._get_visibility_buffer()
+            self.tile_visibility_kernel[self.number_of_tiles * __TILE_PIXELS__](
+                primitives, tile_offsets, tile_entries, large_count, large_primitives, viewport_dim,
+                self._depth_buffer, self._hiz, visibility_buffer, self._statistics, self._get_overdraw_target())
+            self.small_visibility_kernel.indirect(max_primitives, small_count)(
+                primitives, small_primitives, viewport_dim, self._depth_buffer, visibility_buffer)
+            visibility_resolve[self._render_target.width * self._render_target.height](
+                primitives, visibility_buffer, *globals_args, self._render_target, self._statistics)
+            return
+        # a work-group per tile rasterizes, depth tests and shades in a single pass
+        tile_raster_kernel[self.number_of_tiles * __TILE_PIXELS__](
+            primitives, tile_offsets, tile_entries, large_count, large_primitives, *globals_args,
+            self._render_target, self._depth_buffer, self._hiz, self._statistics, self._get_overdraw_target())
+        small_raster_kernel.indirect(max_primitives, small_count)(
+            primitives, small_primitives, *globals_args, self._render_target, self._depth_buffer, self._statistics)
+
+    @traced('draw_points', 'draw')
     def draw_points(self, vertex_buffer, index_buffer = None):
         primitive_count = vertex_buffer.shape[0] if index_buffer is None else index_buffer.shape[0]
-        max_primitive_out = primitive_count
-        out_vertex_buffer = create_buffer(primitive_count, self.vertex_output_type)
-        self.vertex_kernel[primitive_count](vertex_buffer, self.vertex_shader_globals, out_vertex_buffer)
-        out_primitive_buffer = create_buffer(max_primitive_out, self.vertex_output_type)
-        out_counter = create_buffer(1, np.int32)
-        self.point_primitive[primitive_count](out_vertex_buffer, index_buffer, out_counter, out_primitive_buffer)
-        visible_primitives = int(out_counter.map_to_host())
-        out_fragments = create_buffer(1, np.int32)
-        out_fragment_buffer = create_buffer(max_primitive_out, self.vertex_output_type)
-        self.point_raster[visible_primitives](out_primitive_buffer, out_fragments, out_fragment_buffer)
-        out_fragments = int(out_fragments.map_to_host())
-        self.homogenization[out_fragments](out_fragment_buffer, make_float2(self._render_target.width, self._render_target.height))  # inplace modification
-        self.depth_test[out_fragments](out_fragment_buffer, self.fragment_shader_globals, self._render_target, self._depth_buffer)
-        self.fragment_kernel[out_fragments](out_fragment_buffer, self.fragment_shader_globals, self._render_target, self._depth_buffer)
+        self._begin_statistics('points')
+        self._stream_batches(vertex_buffer, index_buffer, primitive_count, self.primitive_capacity * 3, 1,
+                             self.point_primitive, (), self._raster_points)
+        self._statistics = None
 
     def draw_triangles(self, vertex_buffer, index_buffer):
-        # TODO: SPLIT IN BATCHES! DO NOT SEND MORE THAN 200000 VERTICES
-        # TODO: Implement fragment tiling.
+        self._draw_triangles(vertex_buffer, index_buffer, None)
+
+    def draw_triangles_instanced(self, vertex_buffer, index_buffer, instance_buffer):
+        """
+        Draws a copy of the mesh for every element of instance_buffer. The vertex shader receives the instance struct
+        (and the instance id if declared as fourth argument).
+        """
+        self._draw_triangles(vertex_buffer, index_buffer, instance_buffer)
+
+    @traced('draw_triangles', 'draw')
+    def _draw_triangles(self, vertex_buffer, index_buffer, instance_buffer):
         primitive_count = (vertex_buffer.shape[0] if index_buffer is None else index_buffer.shape[0])//3
-        max_primitive_out = primitive_count * 2  # every triangle can be split with z=0 plane
-        self.vertex_kernel[primitive_count * 3](vertex_buffer, self.vertex_shader_globals, self.out_vertex_buffer)
-        out_counter = create_buffer(1, np.int32)
-        self.triangle_primitive[primitive_count](self.out_vertex_buffer, index_buffer, out_counter, self.out_primitive_buffer)
-        visible_primitives = int(out_counter.map_to_host())
-        self.homogenization[visible_primitives*3](self.out_primitive_buffer,
-                                                  make_float2(self._render_target.width, self._render_target.height))  # inplace modification
-        drawn_primitives = create_buffer(1, np.int32)
-        while (int(drawn_primitives.map_to_host()) < visible_primitives):
-            counting = create_buffer(1, np.int32)
-            out_fragments = create_buffer(1, np.int32)
-            self.triangle_raster[visible_primitives](self.out_primitive_buffer, drawn_primitives, counting, out_fragments,
-                                                     self.out_fragment_buffer, self.fragments_capacity, make_int2(self._render_target.width, self._render_target.height))
-            out_fragments = int(out_fragments.map_to_host())
-            self.depth_test[out_fragments](self.out_fragment_buffer, self.fragment_shader_globals, self._render_target,
-                                                self._depth_buffer)
-            self.fragment_kernel[out_fragments](self.out_fragment_buffer, self.fragment_shader_globals, self._render_target,
-                                                self._depth_buffer)
+        self._build_hiz()
+        self._begin_statistics('triangles')
+        self._stream_batches(vertex_buffer, index_buffer, primitive_count, self.primitive_capacity, 3,
+                             self.triangle_primitive, (np.int32(self._cull_mode), self._culled, np.int32(0), None),
+                             self._raster_triangles, instance_buffer)
+        self._statistics = None
+
+    def _build_hiz(self):
+        # the depth buffer might have been cleared or written by other draws, coarse depth is rebuilt from it
+        __HIZ_BUILD__[self.number_of_tiles * __TILE_PIXELS__](self._depth_buffer, self._hiz,
+                                                              make_int2(self._render_target.width, self._render_target.height))
+
+    def _upload_draw_globals(self, name, values, dtype):
+        # globals of all draws are gathered in host and transferred at once
+        host = np.empty(len(values), dtype)
+        for i, value in enumerate(values):
+            host[i] = _get_host_mirror(value) if isinstance(value, cla.Array) else value
+        buffer = self.scratch.get(name, len(values), dtype)
+        write_buffer_async(buffer, host)
+        return buffer
+
+    @traced('draw_triangles_list', 'draw')
+    def draw_triangles_list(self, draws):
+        """
+        Draws a list of (vertex_buffer, index_buffer, vertex_globals, fragment_globals) records in a single submission.
+        Vertices are processed and assembled per draw into shared primitive buffers, then binning and raster stages run
+        once per batch of primitive_capacity triangles, shading every triangle with the globals of its draw.
+        index_buffer can be None.
+        """
+        assert self.instance_type is None, "Draw lists require a non-instanced vertex shader"
+        if len(draws) == 0:
+            return
+        vertex_globals = self._upload_draw_globals('draw_vertex_globals', [d[2] for d in draws], self.vertex_globals_type)
+        fragment_globals = self._upload_draw_globals('draw_fragment_globals', [d[3] for d in draws], self.fragment_globals_type)
+        batch_capacity = self.primitive_capacity
+        primitives = self.scratch.get('primitives', batch_capacity * 3 * 2, self.vertex_output_type)
+        primitive_draws = self.scratch.get('primitive_draws', batch_capacity * 2, np.int32)
+        assembly_args = (np.int32(self._cull_mode), self._culled)
+        self._build_hiz()
+        self._begin_statistics('triangle_list')
 
+        batch = {'counter': None, 'count': 0}
 
+        def append(vertices, index_buffer, first, count, primitive_count, vertex_count, draw):
+            if batch['count'] + count > batch_capacity:
+                flush()
+            if batch['counter'] is None:
+                batch['counter'] = self.scratch.get_counter('primitive_counter')
+            self.triangle_primitive[count](vertices, index_buffer, batch['counter'], primitives, first, primitive_count,
+                                           vertex_count, *assembly_args, np.int32(draw), primitive_draws, self._statistics)
+            batch['count'] += count
 
+        def flush():
+            if batch['count'] > 0:
+                self.scratch.track('primitives', batch['counter'])
+                self._raster_triangles(primitives, batch['counter'], batch['count'], primitive_draws, fragment_globals)
+            batch['counter'], batch['count'] = None, 0
 
+        for draw, (vertex_buffer, index_buffer, _, _) in enumerate(draws):
+            # assembly of a draw completes before the next one overwrites the vertices (in-order queue)
+            if index_buffer is None:
+                primitive_count = vertex_buffer.shape[0] // 3
+                for first in range(0, primitive_count, batch_capacity):
+                    count = min(batch_capacity, primitive_count - first)
+                    vertices = self.scratch.get('vertices', count * 3, self.vertex_output_type)
+                    self.vertex_list_kernel[count * 3](vertex_buffer, vertex_globals, np.int32(draw), vertices, np.int32(first * 3))
+                    append(vertices, None, 0, count, count, 0, draw)
+            else:
+                primitive_count = index_buffer.shape[0] // 3
+                if primitive_count == 0:
+                    continue
+                vertex_count = vertex_buffer.shape[0]
+                vertices = self.scratch.get('indexed_vertices', vertex_count, self.vertex_output_type)
+                self.vertex_list_kernel[vertex_count](vertex_buffer, vertex_globals, np.int32(draw), vertices, np.int32(0))
+                for first in range(0, primitive_count, batch_capacity):
+                    append(vertices, index_buffer, first, min(batch_capacity, primitive_count - first), primitive_count,
+                           vertex_count, draw)
+        flush()
+        self._statistics = None
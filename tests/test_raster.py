@@ -0,0 +1,145 @@
+import numpy as np
+import pytest
+
+cl = pytest.importorskip('pyopencl')
+try:
+    if not any(platform.get_devices() for platform in cl.get_platforms()):
+        pytest.skip('no OpenCL device', allow_module_level=True)
+except cl.Error:
+    pytest.skip('no OpenCL platform', allow_module_level=True)
+
+import rendering as ren
+
+
+__WIDTH__ = 320
+__HEIGHT__ = 240
+
+
+@ren.kernel_struct
+class QuadInfo:
+    Scale: np.float32
+    View: ren.float4x4
+    Proj: ren.float4x4
+
+
+@ren.kernel_struct
+class QuadVertex:
+    proj: ren.float4
+    C: ren.float3
+
+
+@ren.kernel_function
+def quad_transform(vertex: ren.MeshVertex, info: QuadInfo) -> QuadVertex:
+    """
+    float4 H = (float4)(vertex.P.x * info.Scale, vertex.P.y * info.Scale, vertex.P.z, 1.0f);
+    H = mul(H, info.View);
+    QuadVertex o;
+    o.proj = mul(H, info.Proj);
+    o.C = (float3)(1, 1, 1);
+    return o;
+    """
+
+
+@ren.kernel_function
+def quad_white(fragment: QuadVertex, info: QuadInfo) -> ren.float4:
+    """
+    return (float4)(fragment.C, 1);
+    """
+
+
+def _create_raster(scale: float, perspective: bool):
+    render_target = ren.create_offline_presenter(__WIDTH__, __HEIGHT__).get_render_target()
+    info = ren.create_struct(QuadInfo)
+    with ren.mapped(info) as map:
+        map['Scale'] = scale
+        if perspective:
+            map['View'] = ren.look_at(ren.make_float3(0.1, 0.3, 1.7), ren.make_float3(0, 0, 0.5), ren.make_float3(0, 1, 0))
+            map['Proj'] = ren.perspective(aspect_ratio=__WIDTH__ / __HEIGHT__)
+        else:  # positions are already in clip space
+            map['View'] = ren.identity()
+            map['Proj'] = ren.identity()
+    raster = ren.Raster(render_target, quad_transform, info, quad_white, info)
+    raster.collect_statistics = True
+    raster.collect_overdraw = True
+    raster.reset_overdraw()
+    return raster
+
+
+def _vertices(positions):
+    vertices = np.zeros(len(positions), ren.MeshVertex)
+    for i, p in enumerate(positions):
+        vertices['P'][i] = (*p, 0)
+    return ren.create_buffer_from(vertices)
+
+
+def _draw(raster, vertices):
+    ren.clear(raster.get_render_target())
+    ren.clear(raster.get_depth_buffer(), 1.0)
+    raster.draw_triangles(vertices, None)
+    overdraw = raster.get_overdraw().get().reshape(__HEIGHT__, __WIDTH__)
+    return raster.get_pipeline_statistics()[-1], overdraw
+
+
+@pytest.mark.parametrize('shading_mode', list(ren.ShadingMode))
+def test_full_screen_triangle_is_rastered_by_all_tiles(shading_mode):
+    raster = _create_raster(1.0, perspective=False)
+    raster.shading_mode = shading_mode
+    # a single triangle containing the whole viewport
+    statistics, overdraw = _draw(raster, _vertices([(-1, -1, 0.5), (3, -1, 0.5), (-1, 3, 0.5)]))
+    # it is not walked by a single thread (small list) nor binned, every tile work-group rasters its part
+    assert statistics['large_primitives'] == 1
+    assert statistics['small_primitives'] == 0
+    assert statistics['binned_tiles'] == 0
+    assert statistics['fragments'] == __WIDTH__ * __HEIGHT__
+    assert (overdraw == 1).all()
+
+
+def test_small_triangle_skips_binning():
+    raster = _create_raster(1.0, perspective=False)
+    # a few pixels inside the first tile
+    statistics, overdraw = _draw(raster, _vertices([(-1, -1, 0.5), (-0.97, -1, 0.5), (-1, -0.97, 0.5)]))
+    assert statistics['small_primitives'] == 1
+    assert statistics['binned_tiles'] == 0
+    assert statistics['fragments'] == overdraw.sum() > 0
+    raster.small_triangle_pixels = 0
+    statistics, _ = _draw(raster, _vertices([(-1, -1, 0.5), (-0.97, -1, 0.5), (-1, -0.97, 0.5)]))
+    assert statistics['small_primitives'] == 0
+    assert statistics['binned_tiles'] == 1
+
+
+@pytest.mark.parametrize('shading_mode', list(ren.ShadingMode))
+@pytest.mark.parametrize('scale', [2.0, 50.0, 1000.0])
+def test_large_quad_is_watertight(shading_mode, scale):
+    # two triangles sharing a diagonal, clipped at z=0 for the larger scales
+    raster = _create_raster(scale, perspective=True)
+    raster.shading_mode = shading_mode
+    quad = _vertices([(-1, -1, 0.5), (1, -1, 0.5), (1, 1, 0.5), (-1, -1, 0.5), (1, 1, 0.5), (-1, 1, 0.5)])
+    _, overdraw = _draw(raster, quad)
+    assert (overdraw == 1).all(), f'{(overdraw == 0).sum()} pixels uncovered, {(overdraw > 1).sum()} covered twice'
+
+
+@pytest.mark.parametrize('shading_mode', list(ren.ShadingMode))
+def test_points_on_the_viewport_edge_are_clipped(shading_mode):
+    raster = _create_raster(1.0, perspective=False)
+    raster.shading_mode = shading_mode
+    # x = w maps to the column past the last one, it must not wrap to the next row
+    ren.clear(raster.get_render_target())
+    ren.clear(raster.get_depth_buffer(), 1.0)
+    raster.draw_points(_vertices([(1, 0, 0.5), (0, 0, 0.5)]), None)
+    overdraw = raster.get_overdraw().get().reshape(__HEIGHT__, __WIDTH__)
+    assert raster.get_pipeline_statistics()[-1]['fragments'] == overdraw.sum() == 1
+    assert overdraw[:, 0].sum() == 0
+
+
+def test_scratch_trim_releases_memory_above_the_recent_peak():
+    scratch = ren.ScratchArena()
+    scratch.get('counter', 1, np.int32)
+    scratch.get('large', 1 << 20, np.float32)
+    scratch.get('unused', 1000, np.float32)
+    scratch.trim()  # everything was requested since the arena was created
+    assert scratch.get_allocated_bytes() == 256 + (4 << 20) + 4096
+    scratch.get('counter', 1, np.int32)
+    scratch.get('large', 1000, np.float32)
+    scratch.trim()
+    assert set(scratch.memory) == {'counter'}
+    assert scratch.get('large', 1000, np.float32).nbytes == 4096